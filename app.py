@@ -4,27 +4,97 @@
 Commercial Airline Passenger Numbers Tool
 
 Usage:
-    ./app.py get_wikipedia_content <output_file>
+    ./app.py get_wikipedia_content <output_file> [--workers=<num>]
+                                   [--block-workers=<num>] [--pattern=<glob>]
+                                   [--format=<name>] [--manifest=<file>]
+    ./app.py convert_extract <input_file> <output_file> [--format=<name>]
     ./app.py pluck_airport_meta_data <input_file> <output_file> [--start=<line>]
+                                     [--workers=<num>] [--cache=<file>]
+                                     [--cache-size=<mb>] [--clear-cache]
+                                     [--batch-size=<num>]
+                                     [--html-parser=<name>]
+                                     [--wikipedia-url=<url>]
+                                     [--fetch-threads=<num>]
+                                     [--page-cache=<location>]
+                                     [--page-cache-ttl=<days>]
+                                     [--changes=<file>]
+                                     [--stats=<file>] [--stats-every=<seconds>]
+                                     [--profile=<dir>]
+                                     [--time-budget=<seconds>]
     ./app.py test
     ./app.py (-h | --help)
 
 Options:
-    -h, --help      Show this screen and exit.
-    --start=<line>  Line number to start from (1 is the first line) [Default: 1]
+    -h, --help       Show this screen and exit.
+    --start=<line>   Line number to start from (1 is the first line). Without
+                     it the run resumes from <output_file>.checkpoint
+    --workers=<num>  Number of processes to run in parallel [Default: 1]
+    --block-workers=<num>  Number of processes decompressing a single
+                     multistream dump shard [Default: 1]
+    --pattern=<glob>  Dump shards to extract
+                     [Default: enwiki-*-pages-articles*.xml-*.bz2]
+    --format=<name>  Extract file format: json or packed, a compressed
+                     format with an index [Default: json]
+    --manifest=<file>  Only extract the pages changed since the run that wrote
+                     this manifest and list the changes in
+                     <output_file>.changes
+    --cache=<file>   SQLite file to cache each article's results in
+    --cache-size=<mb>  Largest the cache can grow to [Default: 512]
+    --clear-cache    Empty the cache before starting
+    --batch-size=<num>  Number of articles to parse together. Their pandoc
+                     fallbacks are converted by a single pandoc process
+                     [Default: 10]
+    --html-parser=<name>  BeautifulSoup tree builder: lxml, html.parser or
+                     html5lib [Default: lxml]
+    --wikipedia-url=<url>  Where to fetch Wikipedia pages from
+                     [Default: https://en.wikipedia.org]
+    --fetch-threads=<num>  Number of threads fetching Wikipedia pages
+                     [Default: 4]
+    --page-cache=<location>  Where to cache fetched pages: a redis:// URL, a
+                     directory, memory or none
+                     [Default: redis://localhost:6379/0]
+    --page-cache-ttl=<days>  Days before a cached page is fetched again
+                     [Default: 30]
+    --changes=<file>  Changes listed by an incremental get_wikipedia_content
+                     run to apply to the existing <output_file>
+    --stats=<file>   Append the time taken by each stage of the pipeline, and
+                     how often each fallback was needed, to this file as JSON
+                     lines
+    --stats-every=<seconds>  How often to write to the stats file
+                     [Default: 60]
+    --profile=<dir>  Write a cProfile profile of each stage to this directory
+    --time-budget=<seconds>  Seconds an article can take to render before its
+                     route tables are read from the wikitext instead, 0 for
+                     no limit [Default: 10]
 """
+import BaseHTTPServer
 import bz2
 import codecs
-from collections import Counter
+from collections import Counter, defaultdict, deque, OrderedDict
+from contextlib import contextmanager
+import cProfile
 from glob import glob
 from hashlib import sha1
 from itertools import chain
 import json
+import math
+import mmap
+from multiprocessing import Pool, TimeoutError
+from multiprocessing.pool import ThreadPool
 import os
+import pstats
 import re
+import shutil
+import signal
+import sqlite3
+import struct
 import sys
 import tempfile
+import threading
+import time
 from urllib import quote
+import uuid
+import zlib
 
 from bs4 import BeautifulSoup
 from creole import Parser
@@ -32,7 +102,6 @@ from creole.html_emitter import HtmlEmitter
 from docopt import docopt
 from LatLon import string2latlon
 from lxml import etree
-import ratelim
 import redis
 import requests
 import sh
@@ -43,50 +112,456 @@ from unidecode import unidecode
 """
 Web scraping methods
 """
-@ratelim.greedy(3, 10) # 3 calls / 10 seconds
-def get_wikipedia_page_from_internet(url_suffix):
-    url = 'https://en.wikipedia.org%s' % url_suffix
-    resp = requests.get(url)
-    assert resp.status_code == 200, (resp, url)
-    return resp.content
+class WikipediaFetcher(object):
+    """
+    Fetches pages from Wikipedia on a pool of threads sharing one pooled
+    HTTP session so downloads happen while articles are being parsed. All of
+    the threads share a single rate limit of max_calls requests every period
+    seconds. base_url can point at a local stand-in server.
+
+    >>> server = serve_stub_pages({'/wiki/Test_Airport': 'Hello'})
+    >>> fetcher = WikipediaFetcher('http://127.0.0.1:%d' % server.server_port)
+    >>> fetcher.get('/wiki/Test_Airport')
+    'Hello'
+    >>> fetcher.fetch_async(len, '/wiki/Test_Airport').get()
+    18
+    >>> fetcher.close()
+    >>> server.shutdown()
+    """
+
+    def __init__(self,
+                 base_url='https://en.wikipedia.org',
+                 max_calls=3,
+                 period=10,
+                 threads=4):
+        self.base_url = base_url.rstrip('/')
+        self.max_calls, self.period = max_calls, period
+        self.calls = deque()
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=threads)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool = ThreadPool(processes=threads)
+
+    def wait_for_turn(self):
+        with self.lock:
+            while len(self.calls) >= self.max_calls:
+                wait = self.calls[0] + self.period - time.time()
+
+                if wait > 0:
+                    time.sleep(wait)
+
+                self.calls.popleft()
+
+            self.calls.append(time.time())
+
+    def get(self, url_suffix):
+        url = self.base_url + url_suffix
+        self.wait_for_turn()
+        resp = self.session.get(url, timeout=60)
+        assert resp.status_code == 200, (resp, url)
+        return resp.content
+
+    def fetch_async(self, func, url_suffix):
+        """
+        Run func(url_suffix) on one of the fetcher's threads.
+        """
+        return self.pool.apply_async(func, (url_suffix,))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.session.close()
+
+    def terminate(self):
+        """
+        Drop the queued fetches rather than waiting for their turn. Fetches
+        already underway are left to finish on their own.
+        """
+        self.pool.terminate()
+        self.session.close()
+
+
+def serve_stub_pages(pages, port=0):
+    """
+    Serve pages, a dict of path to content, from a local HTTP server running
+    on a background thread. Stands in for Wikipedia when testing.
+    """
+    class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
+        def do_GET(self):
+            if self.path not in pages:
+                self.send_error(404)
+                return
 
-def get_wikipedia_page(url_suffix):
-    redis_con = redis.StrictRedis()
-    redis_key = 'wikipedia_%s' % sha1(url_suffix).hexdigest()[:6]
-    resp = redis_con.get(redis_key)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.end_headers()
+            self.wfile.write(pages[self.path])
 
-    if resp is not None:
-        return resp
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), StubHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+
+class PageCache(object):
+    """
+    Cache of pages fetched from Wikipedia. Pages are stored zlib compressed
+    under the full SHA-1 of their URL and expire after ttl seconds. The
+    backends only need to implement get_values and set_value.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.counts = Counter()
+
+    @staticmethod
+    def get_key(url_suffix):
+        return 'wikipedia_page:%s' % sha1(url_suffix).hexdigest()
+
+    def get_many(self, url_suffixes):
+        """
+        Look up several pages with a single round trip.
+
+        :returns: the HTML of each page found by its URL
+        :rtype: dict
+
+        >>> page_cache = MemoryPageCache()
+        >>> page_cache.set('/wiki/A', '<html>A</html>')
+        >>> page_cache.get_many(['/wiki/A', '/wiki/B'])
+        {'/wiki/A': '<html>A</html>'}
+        >>> sorted(page_cache.counts.items())
+        [('hits', 1), ('misses', 1)]
+        """
+        url_suffixes = list(url_suffixes)
+
+        if not url_suffixes:
+            return {}
+
+        values = self.get_values([self.get_key(url_suffix)
+                                  for url_suffix in url_suffixes])
+        pages = {url_suffix: zlib.decompress(value)
+                 for url_suffix, value in zip(url_suffixes, values)
+                 if value is not None}
+
+        self.counts['hits'] += len(pages)
+        self.counts['misses'] += len(url_suffixes) - len(pages)
+
+        return pages
+
+    def get(self, url_suffix):
+        return self.get_many([url_suffix]).get(url_suffix)
+
+    def set(self, url_suffix, html):
+        self.set_value(self.get_key(url_suffix), zlib.compress(html))
+
+    def close(self):
+        pass
+
+
+class RedisPageCache(PageCache):
+    """
+    Redis backed cache sharing one connection pool between the fetcher's
+    threads. Expired pages are dropped by Redis itself, how pages are evicted
+    before then is down to the server's maxmemory-policy.
+    """
+
+    def __init__(self, url='redis://localhost:6379/0', ttl=None):
+        super(RedisPageCache, self).__init__(ttl)
+        self.redis_con = redis.StrictRedis(
+            connection_pool=redis.ConnectionPool.from_url(url))
+
+    def get_values(self, keys):
+        return self.redis_con.mget(keys)
+
+    def set_value(self, key, value):
+        self.redis_con.set(key, value, ex=self.ttl or None)
+
+
+class FilePageCache(PageCache):
+    """
+    Cache kept as one file per page in a directory, for runs without a Redis
+    server. Pages older than the TTL are treated as missing.
+    """
+
+    def __init__(self, directory, ttl=None):
+        super(FilePageCache, self).__init__(ttl)
+        self.directory = directory
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_values(self, keys):
+        values = []
+
+        for key in keys:
+            file_name = os.path.join(self.directory, key.split(':')[1])
+
+            try:
+                if self.ttl and \
+                   os.path.getmtime(file_name) + self.ttl < time.time():
+                    values.append(None)
+                    continue
+
+                with open(file_name, 'r+b') as f:
+                    values.append(f.read())
+            except (IOError, OSError):
+                values.append(None)
+
+        return values
+
+    def set_value(self, key, value):
+        file_name = os.path.join(self.directory, key.split(':')[1])
+        temp_file = '%s.%s.tmp' % (file_name, uuid.uuid4().hex)
+
+        with open(temp_file, 'w+b') as f:
+            f.write(value)
+
+        os.rename(temp_file, file_name)
+
+
+class MemoryPageCache(PageCache):
+    """
+    In-process cache holding at most max_pages pages, evicting the least
+    recently used.
+    """
+
+    def __init__(self, ttl=None, max_pages=1000):
+        super(MemoryPageCache, self).__init__(ttl)
+        self.max_pages = max_pages
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_values(self, keys):
+        values = []
+
+        with self.lock:
+            for key in keys:
+                expires, value = self.pages.pop(key, (None, None))
+
+                if expires is not None and expires < time.time():
+                    value = None
+                elif value is not None:
+                    self.pages[key] = expires, value
+
+                values.append(value)
+
+        return values
+
+    def set_value(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+
+        with self.lock:
+            self.pages.pop(key, None)
+            self.pages[key] = expires, value
+
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+
+
+def open_page_cache(location, ttl=None):
+    """
+    :param str location: a redis:// URL, "memory", "none" or a directory
+    """
+    if location == 'none':
+        return None
+
+    if location == 'memory':
+        return MemoryPageCache(ttl)
+
+    if location.startswith('redis://'):
+        return RedisPageCache(location, ttl)
+
+    return FilePageCache(location, ttl)
+
+
+def get_wikipedia_page(url_suffix, fetcher, page_cache=None, check_cache=True):
+    """
+    :param bool check_cache: False when the page is already known to be
+                             missing from page_cache, it's still stored there
+                             once fetched
+    """
+    html = None
+
+    if page_cache is not None and check_cache:
+        with timed('page_cache'):
+            html = page_cache.get(url_suffix)
+
+    if html is not None:
+        return html
+
+    with timed('http'):
+        html = fetcher.get(url_suffix)
+
+    if page_cache is not None:
+        page_cache.set(url_suffix, html)
 
-    html = get_wikipedia_page_from_internet(url_suffix)
-    redis_con.set(redis_key, html)
-    
     return html
 
 
 """
 Markdown-related methods
 """
-def markdown_to_html_pandocs(text):
+HTML_PARSERS = ('lxml', 'html.parser', 'html5lib')
+TABLE_ROW = re.compile(r'<tr[\s>]', re.IGNORECASE)
+
+# Footnotes, abbreviations and reference link definitions
+DOCUMENT_WIDE_MARKDOWN = re.compile(r'\[\^|\*\[|^\s*\[[^\]]+\]:',
+                                    re.MULTILINE)
+
+# The tree builder used for BeautifulSoup. html5lib is the slowest but copes
+# best with broken markup so it's used whenever a faster parser's soup is
+# missing table rows.
+html_parser = 'lxml'
+
+# Counters and the seconds each call to a stage of the pipeline took for the
+# current process. Pool workers hand theirs back with each batch of results.
+pipeline_counts = Counter()
+pipeline_timings = defaultdict(list)
+
+# cProfile profiles of each stage, only kept when profiling
+pipeline_profiles = None
+active_profiles = []
+
+
+@contextmanager
+def timed(stage):
     """
-    This works well on some South American airports
+    Time a stage of the pipeline. When profiling, the outermost stage running
+    on a process' main thread is profiled as well, the stages inside it are
+    included in its profile.
     """
-    output_file = tempfile.NamedTemporaryFile(delete=False)
-    file_name = output_file.name
-    output_file.close()
+    profile = None
+
+    if pipeline_profiles is not None and not active_profiles and \
+       threading.current_thread().name == 'MainThread':
+        profile = pipeline_profiles.setdefault(stage, cProfile.Profile())
+        active_profiles.append(profile)
+        profile.enable()
+
+    start = time.time()
+
+    try:
+        yield
+    finally:
+        pipeline_timings[stage].append(time.time() - start)
+
+        if profile is not None:
+            profile.disable()
+            active_profiles.pop()
+
+
+def enable_profiling():
+    global pipeline_profiles
+    pipeline_profiles = {}
+
+
+def dump_profiles(profile_dir):
+    """
+    Write this process' profile of each stage to profile_dir.
+    """
+    for stage, profile in (pipeline_profiles or {}).items():
+        profile.dump_stats(os.path.join(profile_dir,
+                                        '%s.%d.prof' % (stage, os.getpid())))
+
+
+def set_html_parser(parser):
+    global html_parser
+    assert parser in HTML_PARSERS, parser
+    html_parser = parser
+
+
+def make_soup(html):
+    with timed('soup'):
+        soup = BeautifulSoup(html, html_parser)
+        pipeline_counts['soup.%s' % html_parser] += 1
+
+        if html_parser == 'html5lib':
+            return soup
+
+        # Infoboxes and route tables are both rendered as tables so if the
+        # faster parser lost any rows fall back on html5lib.
+        if len(soup.find_all('tr')) >= len(TABLE_ROW.findall(html)):
+            return soup
+
+        pipeline_counts['soup.html5lib_fallback'] += 1
+        return BeautifulSoup(html, "html5lib")
 
-    with codecs.open(file_name, 'w+b', encoding='utf-8') as write_file:
-        write_file.write(text)
 
-    html = str(pandoc('-f',
+def markdown_to_html_pandocs(text):
+    """
+    This works well on some South American airports
+    """
+    return str(pandoc('-f',
                       'markdown_phpextra',
                       '-t',
                       'html',
-                      output_file.name))
-    os.unlink(file_name)
+                      _in=text.encode('utf8')))
 
-    return html
+
+def markdowns_to_html_pandocs(texts):
+    """
+    Convert a batch of documents with a single pandoc process rather than
+    starting one per document. The documents are joined with a raw HTML
+    comment, which pandoc passes through untouched, and the output is split
+    on it again. Should the output not split back into one part per document
+    each document is converted on its own instead.
+
+    Footnotes, reference link definitions and abbreviations apply to the
+    whole of a pandoc document, and an unclosed HTML comment would swallow
+    the separator, so documents with either are always converted on their
+    own.
+
+    >>> texts = [u'Opened in 1929.[^1]\\n\\n[^1]: As an airfield.',
+    ...          u"''Alpha'' Field <!-- unfinished",
+    ...          u'One runway.',
+    ...          u'Two terminals.']
+    >>> markdowns_to_html_pandocs(texts) == \\
+    ...     [markdown_to_html_pandocs(text) for text in texts]
+    True
+    """
+    def convert(text):
+        try:
+            return markdown_to_html_pandocs(text)
+        except (sh.ErrorReturnCode_2):
+            return ''
+
+    def convert_batch(texts):
+        if len(texts) < 2:
+            return [convert(text) for text in texts]
+
+        separator = '<!-- pandoc-batch-%s -->' % uuid.uuid4().hex
+
+        try:
+            html = markdown_to_html_pandocs(
+                (u'\n\n%s\n\n' % separator).join(texts))
+        except (sh.ErrorReturnCode_2):
+            html = ''
+
+        htmls = html.split(separator)
+
+        if len(htmls) != len(texts):
+            return [convert(text) for text in texts]
+
+        return [html.strip('\n') + '\n' for html in htmls]
+
+    batched = [index
+               for index, text in enumerate(texts)
+               if not DOCUMENT_WIDE_MARKDOWN.search(text) and
+                  text.count('<!--') <= text.count('-->')]
+    htmls = dict(zip(batched, convert_batch([texts[index]
+                                             for index in batched])))
+
+    return [htmls[index] if index in htmls else convert(text)
+            for index, text in enumerate(texts)]
 
 
 def slugify(val):
@@ -147,95 +622,185 @@ class WikiLinkHtmlEmitter(HtmlEmitter):
 """
 Property plucking methods
 """
+def index_properties(soup, prop_names):
+    """
+    Look up several properties with a single pass over the soup's table
+    cells. A property matches a "key = value" cell holding exactly one "="
+    when the key, lower cased and without spaces, ends with the property's
+    name. A property's value is the first match's value, or None if none of
+    its matches have a value.
+
+    :returns: property values by property name
+    :rtype: dict
+
+    >>> soup = BeautifulSoup(u'''<table>
+    ...     <tr><td>Name = </td><td>Airport Name = Sky Harbor</td></tr>
+    ...     <tr><td>IATA = PHX</td><td>ICAO = KPHX = KPHX</td></tr>
+    ... </table>''', "html5lib")
+    >>> props = index_properties(soup, ('name', 'IATA', 'ICAO'))
+    >>> [props[prop] for prop in ('name', 'IATA', 'ICAO')]
+    [u'', u'PHX', None]
+    """
+    names = {prop_name.lower(): prop_name for prop_name in prop_names}
+    lengths = set(len(name) for name in names)
+    matches = {}
+
+    for td in soup.find_all('td'):
+        text = td.text
+
+        if text.count('=') != 1:
+            continue
+
+        key, value = text.split('=')
+        key, value = key.lower().replace(' ', ''), value.strip()
+
+        for length in lengths:
+            if len(key) < length or key[-length:] not in names:
+                continue
+
+            # The first value found and whether any value was non-empty
+            match = matches.setdefault(key[-length:], [value, False])
+            match[1] = match[1] or bool(value)
+
+    return {prop_name: matches[name][0]
+                       if name in matches and matches[name][1] else None
+            for name, prop_name in names.items()}
+
+
 def parse_property(soup, prop_name):
-    prop_name = prop_name.lower()
-    props = [td.text.split('=')[1].strip()
-             for td in soup.find_all('td')
-             if '%s=' % prop_name in td.text.lower().replace(' ', '') and
-                len(td.text.split('=')) == 2]
-    return props[0] if any(props) else None
+    return index_properties(soup, (prop_name,))[prop_name]
 
 
 def get_airport_meta_data(soup):
     """
     This works well for many Asia and some European airports.
     """
-    props = {}
+    return index_properties(soup, ('name', 'IATA', 'ICAO', 
+                                   'latd', 'latm', 'lats', 'latNS', 
+                                   'longd', 'longm', 'longs', 'longEW',))
 
-    for prop in ('name', 'IATA', 'ICAO', 
-                 'latd', 'latm', 'lats', 'latNS', 
-                 'longd', 'longm', 'longs', 'longEW',):
-        props[prop] = parse_property(soup, prop)
 
-    return props
+AIRPORT_HREF = re.compile('Airport')
+NUMBER_CHARACTERS = re.compile(r'[0-9\.\, ]*\Z')
+NON_NUMBER_CHARACTERS = re.compile(r'[^0-9\.]')
 
 
 def get_href(cell):
-    cells = [cell
-             for cell in cell.find_all('a')
-             if 'Airport' in cell.get('href', '')]
-    return cells[0].get('href') if len(cells) else None
+    link = cell.find('a', href=AIRPORT_HREF)
+    return link.get('href') if link is not None else None
 
 
 def is_parseable_number(value):
     try:
-        _ = float(re.sub('[^0-9\.]*', '', value))
+        _ = float(NON_NUMBER_CHARACTERS.sub('', value))
         return True
     except:
         return False
 
 
-def is_possible_number(value):
+def parse_number(value):
+    """
+    :returns: the value as a number or None if it's made up of anything
+              other than digits, dots, commas and spaces or doesn't parse
+    :rtype: float
+    """
     if type(value) not in (str, unicode):
-        return False
+        return None
 
     value = value.strip()
 
-    if len(re.sub('[0-9\.\,\ ]*', '', value)):
-        return False
+    if not NUMBER_CHARACTERS.match(value):
+        return None
+
+    try:
+        return float(NON_NUMBER_CHARACTERS.sub('', value))
+    except ValueError:
+        return None
+
+
+def is_possible_number(value):
+    return parse_number(value) is not None
+
+
+def pluck_row_passengers(cells):
+    """
+    Classify a table row in a single pass over its cells.
+
+    :param cells: text and airport link of each of the row's cells
+    :returns: the first airport linked to and the first number over 1,000,
+              or None if the row doesn't link to an airport or has no
+              number over 2,020
+    :rtype: tuple
+    """
+    airport, amount, found_amount = None, None, False
+
+    for text, href in cells:
+        if airport is None and \
+           href is not None and \
+           '/wiki/' in href and \
+           'Airport' in href:
+            airport = href
+
+        number = parse_number(text)
+
+        if number is None:
+            continue
+
+        if amount is None and number > 1000:
+            amount = number
+
+        # 2020 so that years aren't mistaken for passenger numbers
+        if number > 2020:
+            found_amount = True
 
-    return is_parseable_number(value)
+    if airport is None or not found_amount:
+        return None
+
+    return airport, long(amount)
 
 
 def pluck_passenger_numbers(soup):
     """
     This works well for many Asia and some European airports.
 
-    Pluck all table cells into a grid. Pair links with their linking values.
+    Pair the airport links in each table row with their passenger numbers.
+
+    >>> soup = BeautifulSoup(u'''<table>
+    ...     <tr><th>Airport</th><th>Passengers</th></tr>
+    ...     <tr><td><a href="/wiki/Heathrow_Airport">Heathrow</a></td>
+    ...         <td>1,234,567</td></tr>
+    ...     <tr><td><a href="/wiki/Dubai_Airport">Dubai</a></td>
+    ...         <td>2014</td></tr>
+    ...     <tr><td><a href="/wiki/Gatwick_Airport">Gatwick</a></td>
+    ...         <td>1,500</td><td>98 765</td></tr>
+    ...     <tr><td><a href="/wiki/Changi_Airport">Changi</a></td>
+    ...         <td>12,345 passengers</td></tr>
+    ...     <tr><td><a href="/wiki/Paris">Paris</a></td><td>45,678</td></tr>
+    ...     <tr><td><a href="https://example.com/Airport">Link</a></td>
+    ...         <td>45,678</td></tr>
+    ...     <tr><td><a href="/wiki/Narita_Airport">Narita</a></td>
+    ...         <td>3.5.1</td><td>4,321.5</td></tr>
+    ...     <tr><td><a href="/wiki/Heathrow_Airport">Heathrow</a></td>
+    ...         <td>7,654,321</td></tr>
+    ... </table>''', "html5lib")
+    >>> for airport, amount in sorted(pluck_passenger_numbers(soup).items()):
+    ...     print airport, amount
+    /wiki/Gatwick_Airport 1500
+    /wiki/Heathrow_Airport 7654321
+    /wiki/Narita_Airport 4321
     """
-    rows = [[(cell.text, get_href(cell))
-             for cell in tr.find_all(['th', 'td'])]
-            for tr in soup.find_all('tr')
-            if len(tr.find_all('td'))]
-
     passenger_numbers = {}
 
-    for row in rows:
-        found_airport = any([True
-                             for cell in row
-                             if cell[1] is not None and
-                                '/wiki/' in cell[1] and 
-                                'Airport' in cell[1]])
-        found_amount = any([True
-                            for cell in row
-                            if is_possible_number(cell[0]) and 
-                               # 2020 so that years aren't mistaken for
-                               # passenger numbers
-                               float(re.sub('[^0-9\.]*', '', cell[0])) > 2020])
-
-        if found_airport and found_amount:
-            airport = [cell[1]
-                       for cell in row
-                       if cell[1] is not None and
-                          '/wiki/' in cell[1] and 
-                          'Airport' in cell[1]][0]
-            amount = [float(re.sub('[^0-9\.]*', '', cell[0]))
-                                for cell in row
-                                if is_possible_number(cell[0]) and 
-                                   float(re.sub('[^0-9\.]*',
-                                                '', 
-                                                cell[0])) > 1000][0]
-            passenger_numbers[airport] = long(amount)
+    for tr in soup.find_all('tr'):
+        if tr.find('td') is None:
+            continue
+
+        row = pluck_row_passengers((cell.text, get_href(cell))
+                                   for cell in tr.find_all(['th', 'td']))
+
+        if row is not None:
+            airport, amount = row
+            passenger_numbers[airport] = amount
 
     return passenger_numbers
 
@@ -290,195 +855,2421 @@ def get_airport_meta_data2(soup):
     return props
 
 
-def get_lat_long(airport_metrics):
-    required_keys = ('latd', 'latm', 'lats', 'latNS', 
-                     'longd', 'longm', 'longs', 'longEW')
-
-    for key in required_keys:
-        if key not in airport_metrics or airport_metrics[key] is None:
-            return None
+INFOBOX_START = re.compile(r'\{\{\s*infobox[ _]airport', re.IGNORECASE)
+TEMPLATE_BRACES = re.compile(r'\{\{|\}\}')
+TEMPLATE_TOKENS = re.compile(r'\{\{|\}\}|\[\[|\]\]|\|')
+WIKI_COMMENT = re.compile(r'<!--.*?(-->|$)', re.DOTALL)
+WIKI_REF = re.compile(r'<ref[^>]*/>|<ref[^>]*>.*?</ref>',
+                      re.DOTALL | re.IGNORECASE)
+WIKI_LINK = re.compile(r'\[\[(?:[^\]|]*\|)?([^\]]*)\]\]')
+WIKI_TAG = re.compile(r'<[^>]+>')
+WIKI_COORD = re.compile(r'\{\{\s*coord\s*\|([^}]*)\}\}', re.IGNORECASE)
+
+# Infobox parameter names for each of the keys the other meta data pluckers
+# produce.
+INFOBOX_KEYS = {
+    'name': 'name',
+    'iata': 'IATA',
+    'icao': 'ICAO',
+    'latd': 'latd',
+    'latm': 'latm',
+    'lats': 'lats',
+    'latns': 'latNS',
+    'longd': 'longd',
+    'longm': 'longm',
+    'longs': 'longs',
+    'longew': 'longEW',
+    'lat_deg': 'latd',
+    'lat_min': 'latm',
+    'lat_sec': 'lats',
+    'lat_dir': 'latNS',
+    'lon_deg': 'longd',
+    'lon_min': 'longm',
+    'lon_sec': 'longs',
+    'lon_dir': 'longEW',
+}
+
+
+def find_infobox(markdown):
+    """
+    :returns: the parameters of the article's airport infobox template
+    :rtype: unicode
+    """
+    match = INFOBOX_START.search(markdown)
 
-    try:
-        return string2latlon('%s %s %s %s' % (airport_metrics['latd'],
-                                              airport_metrics['latm'],
-                                              airport_metrics['lats'],
-                                              airport_metrics['latNS']),
-                             '%s %s %s %s' % (airport_metrics['longd'],
-                                              airport_metrics['longm'],
-                                              airport_metrics['longs'],
-                                              airport_metrics['longEW']),
-                             'd% %m% %S% %H')
-    except ValueError:
+    if match is None:
         return None
 
+    depth = 0
 
-def pluck_airport_meta_data(in_file, out_file, start_on_line=1):
-    with codecs.open(in_file, 'r+b', 'utf8') as f:
-        wikipedia_pages = [json.loads(line)
-                           for line in f.read().strip().split('\n')]
+    for brace in TEMPLATE_BRACES.finditer(markdown, match.start()):
+        depth += 1 if brace.group() == '{{' else -1
 
-    with codecs.open(out_file, 'a+b', 'utf8') as f:
-        for index, (title, markdown) in enumerate(wikipedia_pages, start=1):
-            if index < start_on_line:
-                continue
-            
-            if index and not index % 100:
-                print '%d of %d' % (index, len(wikipedia_pages))
+        if not depth:
+            return markdown[match.end():brace.start()]
 
-            document = Parser(markdown).parse()
+    return markdown[match.end():]
 
-            html = WikiLinkHtmlEmitter(document).emit()
 
-            try:
-                soup = BeautifulSoup(html, "html5lib")
-            except RuntimeError as exc:
-                if 'maximum recursion depth exceeded' in exc.message:
-                    soup = None
-                else:
-                    raise exc
+def split_template_params(template):
+    """
+    Split a template's body on the pipes which aren't inside a nested
+    template or wiki link.
+    """
+    params, depth, start = [], 0, 0
 
-            if soup is None:
-                continue
+    for token in TEMPLATE_TOKENS.finditer(template):
+        value = token.group()
 
-            try:
-                airport = get_airport_meta_data(soup)
-            except RuntimeError as exc:
-                if 'maximum recursion depth exceeded' in exc.message:
-                    airport = {}
-                else:
-                    raise exc
+        if value in ('{{', '[['):
+            depth += 1
+        elif value in ('}}', ']]'):
+            depth = max(depth - 1, 0)
+        elif not depth:
+            params.append(template[start:token.start()])
+            start = token.end()
 
-            if not airport:
-                continue
+    params.append(template[start:])
 
-            # If too much meta data wasn't collected then try the alternative
-            # meta data plucker. Seems to work better with South American 
-            # airports.
-            if len([1 for val in airport.values() if val is None]) > 6:
-                try:
-                    _html = markdown_to_html_pandocs(markdown)
-                except (sh.ErrorReturnCode_2):
-                    _html = ''
-
-                try:
-                    _soup = BeautifulSoup(_html, "html5lib")
-                    airport = get_airport_meta_data2(_soup)
-                except RuntimeError as exc:
-                    if 'maximum recursion depth exceeded' in exc.message:
-                        airport = {}
-                    else:
-                        raise exc
-
-            if 'name' not in airport or not airport['name']:
-                continue
+    # The first part is whatever followed the template's name
+    return params[1:]
 
-            lat_long = get_lat_long(airport)
 
-            if not lat_long:
-                continue
+def clean_wikitext(value):
+    value = WIKI_COMMENT.sub('', value)
+    value = WIKI_REF.sub('', value)
+    value = WIKI_LINK.sub(r'\1', value)
+    value = WIKI_TAG.sub(' ', value)
+    value = value.replace("'''", '').replace("''", '')
+    return ' '.join(value.split())
 
-            url_key = '/wiki/' + slugify(airport['name'])
-            _airport = {
-                "airport_name": airport['name'],
-                "iata": airport['IATA'],
-                "latitude": float(lat_long.lat),
-                "longitude": float(lat_long.lon),
-                'url': url_key,
-            }
 
-            try:
-                passenger_numbers = pluck_passenger_numbers(soup)
-            except RuntimeError as exc:
-                if 'maximum recursion depth exceeded' in exc.message:
-                    passenger_numbers = {}
-                else:
-                    raise exc
-
-            # Try and get the real HTML from Wikipedia to see if it parses any
-            # better than the markdown generated in this script
-            if not passenger_numbers:
-                try:
-                    html = get_wikipedia_page(url_key)
-                except (AssertionError, requests.exceptions.ConnectionError):
-                    pass # Some pages link to 404s, just move on...
-                else:
-                    try:
-                        soup = BeautifulSoup(html, "html5lib")
-                        passenger_numbers = pluck_passenger_numbers(soup)
-                    except RuntimeError as exc:
-                        if 'maximum recursion depth exceeded' in exc.message:
-                            passenger_numbers = {}
-                        else:
-                            raise exc
-
-            if passenger_numbers:
-                _airport['passengers'] = passenger_numbers
-
-            f.write(json.dumps(_airport, sort_keys=True))
-            f.write('\n')
+def parse_coord_template(value):
+    """
+    Turn a {{coord}} template into the latitude and longitude keys.
+    Handles the degrees/minutes/seconds, decimal degrees with a hemisphere
+    and signed decimal degrees forms.
+    """
+    match = WIKI_COORD.search(value)
 
+    if match is None:
+        return {}
 
-"""
-Data harvesting methods
-"""
-def get_parser(filename):
-    ns_token        = '{http://www.mediawiki.org/xml/export-0.10/}ns'
-    title_token     = '{http://www.mediawiki.org/xml/export-0.10/}title'
-    revision_token  = '{http://www.mediawiki.org/xml/export-0.10/}revision'
-    text_token      = '{http://www.mediawiki.org/xml/export-0.10/}text'
+    parts = [part.strip()
+             for part in match.group(1).split('|')
+             if part.strip() and ':' not in part and '=' not in part]
 
-    with bz2.BZ2File(filename, 'r+b') as bz2_file:
-        for event, element in etree.iterparse(bz2_file, events=('end',)):
-            if element.tag.endswith('page'):
-                namespace_tag = element.find(ns_token)
+    for index, part in enumerate(parts):
+        if part.upper() in ('N', 'S'):
+            latitude, rest = parts[:index], parts[index + 1:]
+            hemispheres = [position
+                           for position, value in enumerate(rest)
+                           if value.upper() in ('E', 'W')]
 
-                if namespace_tag.text == '0':
-                    title_tag = element.find(title_token)
-                    text_tag = element.find(revision_token).find(text_token)
-                    yield title_tag.text, text_tag.text
+            if not hemispheres:
+                return {}
 
-                element.clear()
+            longitude = rest[:hemispheres[0]]
+            lat_dir, long_dir = part.upper(), rest[hemispheres[0]].upper()
+            break
+    else:
+        if len(parts) < 2:
+            return {}
 
+        try:
+            lat, lon = float(parts[0]), float(parts[1])
+        except ValueError:
+            return {}
 
-def pluck_wikipedia_titles_text(pattern='enwiki-*-pages-articles*.xml-*.bz2',
-                               out_file='airport_markdown.json'):
-    with codecs.open(out_file, 'a+b', 'utf8') as out_file:
-        for bz2_filename in sorted(glob(pattern),
-                                   key=lambda a: int(
-                                        a.split('articles')[1].split('.')[0]),
-                                   reverse=True):
-            print bz2_filename
-            parser = get_parser(bz2_filename)
-
-            for title, text in parser:
-                if 'airport' in title.lower():
-                    out_file.write(json.dumps([title, text],
-                                              ensure_ascii=False))
-                    out_file.write('\n')
+        latitude, lat_dir = [str(abs(lat))], 'N' if lat >= 0 else 'S'
+        longitude, long_dir = [str(abs(lon))], 'E' if lon >= 0 else 'W'
 
+    if not 1 <= len(latitude) <= 3 or not 1 <= len(longitude) <= 3:
+        return {}
 
-"""
-Application control methods
-"""
-def main(argv):
+    latitude = (latitude + ['0', '0'])[:3]
+    longitude = (longitude + ['0', '0'])[:3]
+
+    return dict(zip(('latd', 'latm', 'lats', 'latNS',
+                     'longd', 'longm', 'longs', 'longEW'),
+                    latitude + [lat_dir] + longitude + [long_dir]))
+
+
+def get_infobox_meta_data(markdown):
     """
-    :param dict argv: command line arguments
+    Pluck the fields get_airport_meta_data and get_airport_meta_data2 look
+    for straight out of the article's {{Infobox airport}} template in a
+    single pass, without rendering the markdown.
+
+    :returns: airport meta data or None if the article has no infobox
+    :rtype: dict
+
+    >>> meta_data = get_infobox_meta_data(u'''{{Infobox airport
+    ... | name     = [[Heathrow]] Airport<ref>{{cite web|url=x}}</ref>
+    ... | IATA     = LHR
+    ... | ICAO     = EGLL
+    ... | coordinates = {{coord|51|28|39|N|000|27|41|W|type:airport}}
+    ... }}''')
+    >>> [meta_data[key] for key in ('name', 'IATA', 'ICAO', 'latd', 'longEW')]
+    [u'Heathrow Airport', u'LHR', u'EGLL', u'51', u'W']
     """
-    opt = docopt(__doc__, argv)
+    infobox = find_infobox(markdown)
 
-    if opt['test']:
-        import doctest
-        doctest.testmod()
-        return
+    if infobox is None:
+        return None
 
-    if opt['get_wikipedia_content']:
-        pluck_wikipedia_titles_text(out_file=opt['<output_file>'])
+    props = dict.fromkeys(set(INFOBOX_KEYS.values()))
+    coords = {}
+
+    for param in split_template_params(infobox):
+        key, equals, value = param.partition('=')
+
+        if not equals:
+            continue
+
+        key = key.strip().lower()
+
+        if key in ('coordinates', 'coords'):
+            coords = parse_coord_template(value)
+        elif key in INFOBOX_KEYS:
+            props[INFOBOX_KEYS[key]] = clean_wikitext(value) or None
+
+    # Only fall back on the {{coord}} template if the separate latitude and
+    # longitude parameters aren't filled in.
+    for key, value in coords.items():
+        if props[key] is None:
+            props[key] = value
+
+    return props
+
+
+WIKI_TABLE_TOKENS = re.compile(r'\{\{|\}\}|\[\[|\]\]|\|\||!!|\|')
+WIKI_LINK_TARGET = re.compile(r'\[\[([^\]|]*)')
+
+
+def split_wikitext_cells(text, separators):
+    """
+    Split text on the separators which aren't inside a nested template or
+    wiki link.
+    """
+    cells, depth, start = [], 0, 0
+
+    for token in WIKI_TABLE_TOKENS.finditer(text):
+        value = token.group()
+
+        if value in ('{{', '[['):
+            depth += 1
+        elif value in ('}}', ']]'):
+            depth = max(depth - 1, 0)
+        elif not depth and value in separators:
+            cells.append(text[start:token.start()])
+            start = token.end()
+
+    cells.append(text[start:])
+
+    return cells
+
+
+def iter_wikitext_rows(markdown):
+    """
+    Yield the cells of every table row in the article's wikitext, both
+    "{| |- | a || b |}" tables and "|a|b|" rows, a line at a time.
+    """
+    row = None
+
+    for line in markdown.splitlines():
+        line = line.strip()
+
+        if line.startswith('{|'):
+            if row:
+                yield row
+
+            row = []
+        elif row is not None and line.startswith(('|-', '|}')):
+            if row:
+                yield row
+
+            row = [] if line.startswith('|-') else None
+        elif row is not None and line[:1] in ('|', '!'):
+            if line.startswith('|+'):
+                continue
+
+            for cell in split_wikitext_cells(line[1:], ('||', '!!')):
+                # Cells can start with their attributes, 'style="..." | text'
+                row.append(split_wikitext_cells(cell, ('|',))[-1])
+        elif row is not None:
+            if row:
+                row[-1] += '\n' + line
+        elif line.startswith('|') and len(line) > 1:
+            yield split_wikitext_cells(line.strip('|'), ('|',))
+
+
+def get_wikitext_href(cell):
+    for match in WIKI_LINK_TARGET.finditer(cell):
+        href = '/wiki/' + slugify(match.group(1).strip())
+
+        if AIRPORT_HREF.search(href):
+            return href
+
+    return None
+
+
+def get_wikitext_passenger_numbers(markdown):
+    """
+    Depth-safe version of pluck_passenger_numbers which reads the route
+    tables straight from the article's wikitext without building a tree.
+
+    >>> numbers = get_wikitext_passenger_numbers(u'''
+    ... {| class="wikitable"
+    ... ! Rank !! Airport !! Passengers
+    ... |-
+    ... | 1 || [[Heathrow Airport|London]] || 1,234,567
+    ... |-
+    ... | style="text-align:left" | 2
+    ... | [[Gatwick Airport]]{{flagicon|UK}}
+    ... | 98,765
+    ... |}
+    ... |=Rank|=Airport|=Passengers|
+    ... |3|[[Changi Airport]]|2014|
+    ... |4|[[Narita Airport|Tokyo {{small|Narita}}]]|54,321|
+    ... ''')
+    >>> for airport, amount in sorted(numbers.items()):
+    ...     print airport, amount
+    /wiki/Gatwick_Airport 98765
+    /wiki/Heathrow_Airport 1234567
+    /wiki/Narita_Airport 54321
+    """
+    passenger_numbers = {}
+
+    for cells in iter_wikitext_rows(markdown):
+        row = pluck_row_passengers((clean_wikitext(cell),
+                                    get_wikitext_href(cell))
+                                   for cell in cells)
+
+        if row is not None:
+            airport, amount = row
+            passenger_numbers[airport] = amount
+
+    return passenger_numbers
+
+
+def get_lat_long(airport_metrics):
+    required_keys = ('latd', 'latm', 'lats', 'latNS', 
+                     'longd', 'longm', 'longs', 'longEW')
+
+    for key in required_keys:
+        if key not in airport_metrics or airport_metrics[key] is None:
+            return None
+
+    try:
+        return string2latlon('%s %s %s %s' % (airport_metrics['latd'],
+                                              airport_metrics['latm'],
+                                              airport_metrics['lats'],
+                                              airport_metrics['latNS']),
+                             '%s %s %s %s' % (airport_metrics['longd'],
+                                              airport_metrics['longm'],
+                                              airport_metrics['longs'],
+                                              airport_metrics['longEW']),
+                             'd% %m% %S% %H')
+    except ValueError:
+        return None
+
+
+# Articles nested deeper than this, or with more table rows, or longer than
+# this many characters are kept away from the renderers and parsed with the
+# depth-safe wikitext path instead.
+MAX_MARKUP_DEPTH = 100
+MAX_TABLE_ROWS = 5000
+MAX_ARTICLE_SIZE = 2 * 1024 * 1024
+
+LIST_PREFIX = re.compile(r'^[*#:;]+', re.MULTILINE)
+NESTING_TAG = re.compile(r'<(/?)(?:div|span|small|big|center|font|table|'
+                         r'blockquote|ul|ol|li)\b[^>]*?(/?)>',
+                         re.IGNORECASE)
+TABLE_ROW_LINE = re.compile(r'^\s*\|(?:-|[^}+])', re.MULTILINE)
+
+# Seconds each article is given to be rendered and plucked before it's
+# handed to the wikitext path, no budget if None.
+article_time_budget = None
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def is_recursion_error(exc):
+    # Python 2 raises a plain RuntimeError when the recursion limit is hit
+    return isinstance(exc, RuntimeError) and \
+           'maximum recursion depth exceeded' in str(exc)
+
+
+def measure_markup(markdown):
+    """
+    Estimate how deeply an article's markup is nested, from its lists,
+    templates and HTML tags, and how many table rows it has without parsing
+    it.
+
+    :returns: nesting depth and table rows
+    :rtype: tuple
+
+    >>> measure_markup(u'* a\\n*** b\\n{{a|{{b|{{c}}}}}}\\n|x|y|\\n|-\\n|}')
+    (3, 2)
+    >>> measure_markup(u'<div>' * 5 + u'<br/>' + u'</div>' * 5)
+    (5, 0)
+    """
+    depth = max([len(prefix) for prefix in LIST_PREFIX.findall(markdown)] or
+                [0])
+    nesting = 0
+
+    for brace in TEMPLATE_BRACES.finditer(markdown):
+        nesting = nesting + 1 if brace.group() == '{{' else max(nesting - 1, 0)
+        depth = max(depth, nesting)
+
+    nesting = 0
+
+    for tag in NESTING_TAG.finditer(markdown):
+        # Self closing tags don't nest
+        if tag.group(2):
+            continue
+
+        nesting = max(nesting - 1, 0) if tag.group(1) else nesting + 1
+        depth = max(depth, nesting)
+
+    return depth, len(TABLE_ROW_LINE.findall(markdown))
+
+
+def is_pathological(markdown):
+    if len(markdown) > MAX_ARTICLE_SIZE:
+        pipeline_counts['guard.size'] += 1
+        return True
+
+    depth, rows = measure_markup(markdown)
+
+    if depth > MAX_MARKUP_DEPTH:
+        pipeline_counts['guard.depth'] += 1
+        return True
+
+    if rows > MAX_TABLE_ROWS:
+        pipeline_counts['guard.rows'] += 1
+        return True
+
+    return False
+
+
+def set_time_budget(seconds):
+    global article_time_budget
+    article_time_budget = seconds or None
+
+
+@contextmanager
+def time_budget(seconds):
+    """
+    Raise BudgetExceeded inside the block once it has run for seconds. The
+    exception is raised again every 50ms after that in case a bare except
+    swallows it. Budgets only apply on a process' main thread, where signals
+    are delivered, and can't be nested.
+    """
+    if not seconds or \
+       threading.current_thread().name != 'MainThread' or \
+       signal.getitimer(signal.ITIMER_REAL)[0]:
+        yield
+        return
+
+    def exceeded(signum, frame):
+        raise BudgetExceeded()
+
+    previous = signal.signal(signal.SIGALRM, exceeded)
+    signal.setitimer(signal.ITIMER_REAL, seconds, 0.05)
+
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def markdown_to_soup(markdown):
+    try:
+        with timed('creole'):
+            document = Parser(markdown).parse()
+
+            html = WikiLinkHtmlEmitter(document).emit()
+
+        return make_soup(html)
+    except RuntimeError as exc:
+        if is_recursion_error(exc):
+            pipeline_counts['recursion_limit'] += 1
+            return None
+        else:
+            raise exc
+
+
+def pluck_meta_data(markdown):
+    """
+    Render an article's markdown and pluck its infobox from the result.
+
+    :returns: the article's soup and meta data or None if it has neither
+    :rtype: tuple
+    """
+    soup = markdown_to_soup(markdown)
+
+    if soup is None:
+        return None
+
+    try:
+        with timed('meta_data'):
+            airport = get_airport_meta_data(soup)
+    except RuntimeError as exc:
+        if is_recursion_error(exc):
+            pipeline_counts['recursion_limit'] += 1
+            airport = {}
+        else:
+            raise exc
+
+    if not airport:
+        return None
+
+    return soup, airport
+
+
+def needs_pandocs(airport):
+    # If too much meta data wasn't collected then try the alternative
+    # meta data plucker. Seems to work better with South American 
+    # airports.
+    return len([1 for val in airport.values() if val is None]) > 6
+
+
+def pluck_meta_data2(html):
+    try:
+        _soup = make_soup(html)
+
+        with timed('meta_data2'):
+            return get_airport_meta_data2(_soup)
+    except RuntimeError as exc:
+        if is_recursion_error(exc):
+            pipeline_counts['recursion_limit'] += 1
+            return {}
+        else:
+            raise exc
+
+
+def make_airport_record(airport):
+    """
+    :returns: the airport's record without its passenger numbers or None if
+              its name or location are missing
+    :rtype: dict
+    """
+    if 'name' not in airport or not airport['name']:
+        return None
+
+    lat_long = get_lat_long(airport)
+
+    if not lat_long:
+        return None
+
+    url_key = '/wiki/' + slugify(airport['name'])
+
+    return {
+        "airport_name": airport['name'],
+        "iata": airport['IATA'],
+        "latitude": float(lat_long.lat),
+        "longitude": float(lat_long.lon),
+        'url': url_key,
+    }
+
+
+def finish_airport(markdown, soup, airport):
+    """
+    Build the airport record and pluck its passenger numbers. The article is
+    only rendered into soup at this point if its meta data came straight
+    from the infobox. Articles which can't be rendered or plucked without
+    hitting the recursion limit have their route tables read from the
+    wikitext instead.
+    """
+    _airport = make_airport_record(airport)
+
+    if _airport is None:
+        return None
+
+    if soup is None:
+        soup = markdown_to_soup(markdown)
+
+    passenger_numbers = None
+
+    if soup is not None:
+        try:
+            with timed('passengers'):
+                passenger_numbers = pluck_passenger_numbers(soup)
+        except RuntimeError as exc:
+            if is_recursion_error(exc):
+                pipeline_counts['recursion_limit'] += 1
+            else:
+                raise exc
+
+    if passenger_numbers is None:
+        with timed('wikitext'):
+            passenger_numbers = get_wikitext_passenger_numbers(markdown)
+
+    # Articles without passenger numbers get their real HTML fetched from
+    # Wikipedia by fetch_passenger_numbers once they're back with the
+    # parent process.
+    if passenger_numbers:
+        _airport['passengers'] = passenger_numbers
+
+    return _airport
+
+
+def finish_airport_iteratively(markdown, airport):
+    """
+    Depth-safe version of finish_airport which never renders the article.
+    """
+    _airport = make_airport_record(airport) if airport else None
+
+    if _airport is None:
+        return None
+
+    with timed('wikitext'):
+        passenger_numbers = get_wikitext_passenger_numbers(markdown)
+
+    if passenger_numbers:
+        _airport['passengers'] = passenger_numbers
+
+    return _airport
+
+
+def fetch_passenger_numbers(url_key, fetcher, page_cache=None, html=None,
+                            check_cache=True):
+    """
+    Try and get the real HTML from Wikipedia to see if it parses any better
+    than the markdown generated in this script. html is the page if it has
+    already been looked up in the cache, check_cache is False if it was
+    looked up but missing.
+
+    :returns: the passenger numbers, or None if the page couldn't be fetched
+    :rtype: dict
+    """
+    try:
+        if html is None:
+            html = get_wikipedia_page(url_key,
+                                      fetcher,
+                                      page_cache,
+                                      check_cache)
+    except (AssertionError, requests.exceptions.RequestException):
+        pipeline_counts['fetch.failed'] += 1
+        return None # Some pages link to 404s, just move on...
+
+    try:
+        soup = make_soup(html)
+
+        with timed('passengers'):
+            return pluck_passenger_numbers(soup)
+    except RuntimeError as exc:
+        if is_recursion_error(exc):
+            pipeline_counts['recursion_limit'] += 1
+            return {}
+        else:
+            raise exc
+
+
+# Marks the articles in a batch which are only parsed from their wikitext
+WIKITEXT_ONLY = object()
+
+
+def parse_airports(markdowns):
+    """
+    Pluck the meta data and passenger numbers out of a batch of articles.
+    The meta data is read straight from the infobox template where possible.
+    Otherwise the article is rendered to HTML and the articles which then
+    need the pandoc fallback are converted together by a single pandoc
+    process. Articles too big or deeply nested to render, or which run past
+    their time budget, are parsed from their wikitext instead.
+
+    :returns: an airport record, or None if the article isn't usable, for
+              each article
+    :rtype: list
+    """
+    parsed, infoboxes = [], []
+
+    for markdown in markdowns:
+        with timed('infobox'):
+            airport = get_infobox_meta_data(markdown)
+
+        infoboxes.append(airport)
+
+        if is_pathological(markdown):
+            parsed.append(WIKITEXT_ONLY)
+        elif airport is not None and airport['name'] and \
+             get_lat_long(airport):
+            parsed.append((None, airport))
+        else:
+            try:
+                with time_budget(article_time_budget):
+                    meta_data = pluck_meta_data(markdown)
+            except BudgetExceeded:
+                pipeline_counts['guard.time_budget'] += 1
+                meta_data = WIKITEXT_ONLY
+
+            parsed.append(meta_data)
+
+    fallbacks = [index
+                 for index, meta_data in enumerate(parsed)
+                 if meta_data is not None and
+                    meta_data is not WIKITEXT_ONLY and
+                    needs_pandocs(meta_data[1])]
+    pipeline_counts['fallback.pandoc'] += len(fallbacks)
+
+    htmls = []
+
+    # Batches without fallbacks don't run pandoc and aren't timed
+    if fallbacks:
+        with timed('pandoc'):
+            htmls = markdowns_to_html_pandocs([markdowns[index]
+                                               for index in fallbacks])
+
+    for index, html in zip(fallbacks, htmls):
+        parsed[index] = parsed[index][0], pluck_meta_data2(html)
+
+    airports = []
+
+    for markdown, infobox, meta_data in zip(markdowns, infoboxes, parsed):
+        airport = None
+
+        if meta_data is WIKITEXT_ONLY:
+            airport = finish_airport_iteratively(markdown, infobox)
+        elif meta_data is not None:
+            try:
+                with time_budget(article_time_budget):
+                    airport = finish_airport(markdown, *meta_data)
+            except BudgetExceeded:
+                pipeline_counts['guard.time_budget'] += 1
+                airport = finish_airport_iteratively(markdown, meta_data[1])
+
+        airports.append(airport)
+
+    return airports
+
+
+def parse_airport(markdown):
+    """
+    Pluck the meta data and passenger numbers out of a single article.
+
+    :returns: airport record or None if the article isn't usable
+    :rtype: dict
+    """
+    return parse_airports([markdown])[0]
+
+
+def parse_airport_safely(markdown):
+    """
+    Exceptions are handed back with the result rather than raised so a
+    single bad article can't end the run.
+    """
+    try:
+        return parse_airport(markdown), None
+    except Exception as exc:
+        return None, '%s: %s' % (exc.__class__.__name__, exc)
+
+
+def parse_airports_safely(markdowns):
+    """
+    Worker process entry point. If any article in the batch fails, the batch
+    is parsed again one article at a time to find out which. The worker's
+    counters and timings are handed back with the results.
+    """
+    pipeline_counts.clear()
+    pipeline_timings.clear()
+
+    try:
+        results = [(airport, None) for airport in parse_airports(markdowns)]
+    except Exception:
+        results = [parse_airport_safely(markdown) for markdown in markdowns]
+
+    if worker_profile_dir is not None:
+        dump_profiles(worker_profile_dir)
+
+    return results, Counter(pipeline_counts), dict(pipeline_timings)
+
+
+worker_profile_dir = None
+
+
+def configure_worker(parser, profile_dir=None, time_budget=None):
+    global worker_profile_dir
+    set_html_parser(parser)
+    set_time_budget(time_budget)
+
+    if profile_dir is not None:
+        worker_profile_dir = profile_dir
+        enable_profiling()
+
+
+def write_airport(out_file, airport):
+    if airport:
+        out_file.write(json.dumps(airport, sort_keys=True))
+        out_file.write('\n')
+
+
+"""
+Result caching methods
+"""
+# Bump this whenever a change to parse_airport or anything it calls would
+# change its results so stale cache entries are no longer used.
+PARSER_VERSION = '4'
+
+
+class ArticleCache(object):
+    """
+    On-disk cache of parse_airport's results keyed by a hash of the article's
+    markdown, PARSER_VERSION and the HTML tree builder. Articles that didn't
+    produce an airport are cached as well. The least recently used entries
+    are evicted once the cache grows past max_size bytes.
+    """
+
+    def __init__(self, file_name, max_size=512 * 1024 * 1024):
+        self.con = sqlite3.connect(file_name)
+        self.con.execute('CREATE TABLE IF NOT EXISTS articles ('
+                         '    key TEXT PRIMARY KEY,'
+                         '    record TEXT,'
+                         '    size INTEGER,'
+                         '    used INTEGER)')
+        self.max_size = max_size
+        self.size, self.clock = self.con.execute(
+            'SELECT COALESCE(SUM(size), 0), COALESCE(MAX(used), 0) '
+            'FROM articles').fetchone()
+        self.counts = Counter()
+
+    @staticmethod
+    def get_key(markdown):
+        return sha1('%s\n%s\n%s' % (PARSER_VERSION,
+                                    html_parser,
+                                    markdown.encode('utf8'))).hexdigest()
+
+    def get(self, key):
+        """
+        :returns: whether the article was found and its cached result
+        :rtype: tuple
+        """
+        row = self.con.execute('SELECT record FROM articles WHERE key = ?',
+                               (key,)).fetchone()
+
+        if row is None:
+            self.counts['misses'] += 1
+            return False, None
+
+        self.clock += 1
+        self.con.execute('UPDATE articles SET used = ? WHERE key = ?',
+                         (self.clock, key))
+        self.counts['hits'] += 1
+        return True, json.loads(row[0])
+
+    def set(self, key, airport):
+        record = json.dumps(airport, sort_keys=True)
+        self.clock += 1
+        self.con.execute('INSERT OR REPLACE INTO articles VALUES (?, ?, ?, ?)',
+                         (key, record, len(record), self.clock))
+        self.size += len(record)
+
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self, keep=0.9):
+        keys = []
+
+        for key, size in self.con.execute('SELECT key, size FROM articles '
+                                          'ORDER BY used'):
+            if self.size <= self.max_size * keep:
+                break
+
+            keys.append((key,))
+            self.size -= size
+
+        self.con.executemany('DELETE FROM articles WHERE key = ?', keys)
+
+    def clear(self):
+        self.con.execute('DELETE FROM articles')
+        self.con.commit()
+        self.size = 0
+
+    def commit(self):
+        self.con.commit()
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
+
+
+class FinishedResult(object):
+    """
+    Stands in for an AsyncResult when an article's result is already known.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def ready(self):
+        return True
+
+
+# Seconds to wait for a batch's results before its worker is taken to have
+# died. Pool loses the task of a worker that crashes or is killed and would
+# otherwise wait for it forever.
+WORKER_TIMEOUT = 600
+
+
+class BatchResult(object):
+    """
+    Wraps a worker's AsyncResult, adding the worker's counters and timings to
+    this process' the first time the batch's results are read. A batch that
+    isn't back within timeout seconds is parsed again one article per task,
+    so only the article that takes its worker down fails.
+    """
+
+    def __init__(self, pool, markdowns, titles, timeout=WORKER_TIMEOUT):
+        self.pool = pool
+        self.markdowns = markdowns
+        self.titles = titles
+        self.timeout = timeout
+        self.result = pool.apply_async(parse_airports_safely, (markdowns,))
+        self.value = None
+
+    @staticmethod
+    def add_stats(counts, timings):
+        pipeline_counts.update(counts)
+
+        for stage, seconds in timings.items():
+            pipeline_timings[stage].extend(seconds)
+
+    def get(self):
+        if self.value is not None:
+            return self.value
+
+        try:
+            self.value, counts, timings = self.result.get(self.timeout)
+            self.add_stats(counts, timings)
+            return self.value
+        except TimeoutError:
+            pass
+
+        print >> sys.stderr, \
+            'Worker lost parsing %s, parsing them one at a time' % \
+            ', '.join(self.titles)
+        pipeline_counts['worker.lost'] += 1
+        results = [self.pool.apply_async(parse_airports_safely, ([markdown],))
+                   for markdown in self.markdowns]
+        self.value = []
+
+        for result in results:
+            try:
+                value, counts, timings = result.get(self.timeout)
+                self.add_stats(counts, timings)
+            except TimeoutError:
+                value = [(None, 'Worker lost or timed out')]
+
+            self.value.extend(value)
+
+        return self.value
+
+    def ready(self):
+        return self.value is not None or self.result.ready()
+
+
+class PendingArticle(object):
+    """
+    An article waiting for its result to be written out. Articles are parsed
+    in batches, the article's result is at position in its batch's results.
+    """
+
+    def __init__(self, index, offset, title, cache_key=None):
+        self.index = index
+        self.offset = offset
+        self.title = title
+        self.cache_key = cache_key
+        self.result = None
+        self.position = 0
+        self.checked = False
+        self.fetch = None
+
+    def get(self):
+        return self.result.get()[self.position]
+
+
+def read_wikipedia_pages(in_file, start_on_line=1, start_offset=None):
+    """
+    Stream the title and article extract one line at a time. Yields the line
+    number, the byte offset the line ends at, the title and the markdown.
+    Lines before start_on_line are counted but never decoded. When the byte
+    offset of start_on_line is known the lines before it aren't read at all.
+    Packed extracts jump straight to start_on_line using their index.
+    """
+    if is_packed_file(in_file):
+        extract = PackedExtract(in_file)
+
+        try:
+            for page in extract.iter_pages(start_on_line):
+                yield page
+        finally:
+            extract.close()
+
+        return
+
+    with open(in_file, 'r+b') as f:
+        offset, first_line = 0, 1
+
+        if start_offset is not None:
+            f.seek(start_offset)
+            offset, first_line = start_offset, start_on_line
+
+        for index, line in enumerate(iter(f.readline, ''), start=first_line):
+            offset += len(line)
+
+            if index < start_on_line or not line.strip():
+                continue
+
+            title, markdown = json.loads(line)
+            yield index, offset, title, markdown
+
+
+def get_input_identity(in_file):
+    """
+    :returns: the size and modification time of the input file, saved in
+              checkpoints so they aren't used with another input
+    :rtype: dict
+    """
+    return {
+        'input_size': os.path.getsize(in_file),
+        'input_mtime': os.path.getmtime(in_file),
+    }
+
+
+def load_checkpoint(checkpoint_file, in_file, out_file):
+    """
+    Find where a previous run stopped. Records written to the output file
+    after the checkpoint was saved are truncated away so they aren't written
+    twice. Checkpoints saved against a different or regenerated input file
+    are ignored.
+
+    :returns: the line to resume on and its byte offset or None
+    :rtype: dict
+
+    >>> directory = tempfile.mkdtemp()
+    >>> in_file = os.path.join(directory, 'extract.json')
+    >>> out_file = os.path.join(directory, 'stats.json')
+    >>> with open(in_file, 'w+b') as f:
+    ...     f.write('["A", "a"]\\n["B", "b"]\\n')
+    >>> with open(out_file, 'w+b') as f:
+    ...     f.write('{"iata": "AAA"}\\n{"iata": "BBB"}\\n')
+    >>> checkpoint_file = out_file + '.checkpoint'
+    >>> save_checkpoint(checkpoint_file, dict(get_input_identity(in_file),
+    ...                                       line=2,
+    ...                                       offset=11,
+    ...                                       output_size=16))
+    >>> load_checkpoint(checkpoint_file, in_file, out_file)['line']
+    2
+    >>> os.path.getsize(out_file)
+    16
+    >>> os.utime(in_file, (0, 0))
+    >>> load_checkpoint(checkpoint_file, in_file, out_file) is None
+    True
+    >>> shutil.rmtree(directory)
+    """
+    if not os.path.exists(checkpoint_file):
+        return None
+
+    with open(checkpoint_file, 'r+b') as f:
+        checkpoint = json.load(f)
+
+    input_changed = any(checkpoint.get(key) != value
+                        for key, value in get_input_identity(in_file).items())
+
+    if input_changed or \
+       checkpoint['offset'] > os.path.getsize(in_file) or \
+       not os.path.exists(out_file) or \
+       os.path.getsize(out_file) < checkpoint['output_size']:
+        print >> sys.stderr, \
+            '%s does not match the input and output files, ignoring it' % \
+            checkpoint_file
+        return None
+
+    with open(out_file, 'r+b') as f:
+        f.truncate(checkpoint['output_size'])
+
+    return checkpoint
+
+
+def save_checkpoint(checkpoint_file, checkpoint):
+    # Renaming over the old checkpoint means a crash while saving can't
+    # leave a half written file behind.
+    temp_file = checkpoint_file + '.tmp'
+
+    with open(temp_file, 'w+b') as f:
+        json.dump(checkpoint, f)
+
+    os.rename(temp_file, checkpoint_file)
+
+
+def print_parser_counts():
+    parsed = ', '.join('%s %d' % (parser, pipeline_counts['soup.%s' % parser])
+                       for parser in HTML_PARSERS
+                       if pipeline_counts['soup.%s' % parser])
+    print 'HTML parsed with: %s, html5lib fallbacks %d' % (
+        parsed or 'nothing',
+        pipeline_counts['soup.html5lib_fallback'])
+
+
+def get_percentile(timings, percentile):
+    """
+    Nearest rank percentile of a sorted list.
+
+    >>> get_percentile([0.1, 0.2, 0.3, 0.4], 50)
+    0.2
+    >>> get_percentile(range(1, 101), 99)
+    99
+    """
+    index = int(math.ceil(percentile / 100.0 * len(timings))) - 1
+    return timings[max(index, 0)]
+
+
+def get_pipeline_stats(articles, elapsed):
+    """
+    :param int articles: the number of articles written out so far
+    :param float elapsed: seconds since the run started
+    :rtype: dict
+    """
+    stages = {}
+
+    for stage, timings in pipeline_timings.items():
+        if not timings:
+            continue
+
+        timings = sorted(timings)
+        stages[stage] = {
+            'calls': len(timings),
+            'seconds': round(sum(timings), 3),
+            'p50': round(get_percentile(timings, 50), 6),
+            'p95': round(get_percentile(timings, 95), 6),
+            'p99': round(get_percentile(timings, 99), 6),
+        }
+
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'elapsed': round(elapsed, 3),
+        'articles': articles,
+        'articles_per_second': round(articles / max(elapsed, 0.001), 3),
+        'stages': stages,
+        'counts': dict(pipeline_counts),
+        'rates': {
+            rate: round(float(pipeline_counts[count]) / max(articles, 1), 6)
+            for rate, count in (('pandoc_fallback', 'fallback.pandoc'),
+                                ('fetch_fallback', 'fallback.fetch'),
+                                ('fetch_failed', 'fetch.failed'),
+                                ('recursion_limit', 'recursion_limit'))
+        },
+    }
+
+
+def write_pipeline_stats(stats_file, articles, elapsed):
+    with open(stats_file, 'a+b') as f:
+        f.write(json.dumps(get_pipeline_stats(articles, elapsed),
+                           sort_keys=True))
+        f.write('\n')
+
+
+def merge_profiles(profile_dir):
+    """
+    Combine every process' profile of each stage into <stage>.prof.
+    """
+    stages = {}
+
+    for file_name in glob(os.path.join(profile_dir, '*.*.prof')):
+        stage = os.path.basename(file_name).split('.')[0]
+        stages.setdefault(stage, []).append(file_name)
+
+    for stage, file_names in sorted(stages.items()):
+        pstats.Stats(*file_names).dump_stats(
+            os.path.join(profile_dir, '%s.prof' % stage))
+
+        for file_name in file_names:
+            os.unlink(file_name)
+
+    print 'Profiles of %s written to %s' % (', '.join(sorted(stages)) or
+                                            'no stages',
+                                            profile_dir)
+
+
+def pluck_airport_meta_data(in_file,
+                            out_file,
+                            start_on_line=None,
+                            workers=1,
+                            checkpoint_every=100,
+                            cache=None,
+                            batch_size=10,
+                            fetcher=None,
+                            page_cache=None,
+                            stats_file=None,
+                            stats_every=60,
+                            profile_dir=None):
+    pipeline_counts.clear()
+    pipeline_timings.clear()
+
+    in_file_size = os.path.getsize(in_file)
+    input_identity = get_input_identity(in_file)
+    checkpoint_file = out_file + '.checkpoint'
+    start_offset = None
+
+    if start_on_line is None:
+        checkpoint = load_checkpoint(checkpoint_file, in_file, out_file)
+
+        if checkpoint is None:
+            start_on_line = 1
+        else:
+            start_on_line = checkpoint['line']
+            start_offset = checkpoint['offset']
+            print 'Resuming from line %d' % start_on_line
+
+    # The checkpoint only ever moves past lines whose results, and the
+    # results of every line before them, have been written out.
+    last_written = {}
+
+    def commit(f, index, offset, force=False):
+        last_written.update(index=index, offset=offset)
+
+        if not force and index % checkpoint_every:
+            return
+
+        f.flush()
+        os.fsync(f.fileno())
+
+        if cache is not None:
+            cache.commit()
+
+        save_checkpoint(checkpoint_file, dict(
+            input_identity,
+            line=index + 1,
+            offset=offset,
+            output_size=os.fstat(f.fileno()).st_size))
+
+    # Batches of articles are parsed by the pool in the background while the
+    # results are written out in input order. The number of articles in
+    # flight is bounded so memory use doesn't grow with the size of the input.
+    pool = None
+
+    if profile_dir is not None:
+        if not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+
+        enable_profiling()
+
+    if workers > 1:
+        pool = Pool(processes=workers,
+                    initializer=configure_worker,
+                    initargs=(html_parser, profile_dir, article_time_budget))
+
+    # Stage timings are written to stats_file every stats_every seconds
+    started = time.time()
+    stats = {'articles': 0, 'written': started}
+
+    def report_stats(force=False):
+        now = time.time()
+
+        if stats_file is None or \
+           (not force and now - stats['written'] < stats_every):
+            return
+
+        write_pipeline_stats(stats_file, stats['articles'], now - started)
+        stats['written'] = now
+
+    max_pending = max(workers, 1) * 4 * batch_size
+    pending, batch, unchecked = deque(), [], deque()
+    fetcher = fetcher or WikipediaFetcher()
+
+    def start_fetches(articles):
+        fetches = []
+
+        for article in articles:
+            airport, error = article.get()
+            article.checked = True
+
+            if airport and 'passengers' not in airport:
+                fetches.append((article, airport['url']))
+
+        pipeline_counts['fallback.fetch'] += len(fetches)
+
+        # The pages already in the cache are looked up in a single round trip
+        pages = {}
+
+        if page_cache is not None and fetches:
+            with timed('page_cache'):
+                pages = page_cache.get_many(url_key
+                                            for _, url_key in fetches)
+
+        # Pages missing from the batch lookup aren't looked up again
+        for article, url_key in fetches:
+            article.fetch = fetcher.fetch_async(
+                lambda url_key, html=pages.get(url_key):
+                    fetch_passenger_numbers(url_key,
+                                            fetcher,
+                                            page_cache,
+                                            html,
+                                            check_cache=False),
+                url_key)
+
+    def start_ready_fetches():
+        # Fetch pages from Wikipedia as soon as the article's batch has been
+        # parsed rather than when the article is due to be written out.
+        articles = []
+
+        while unchecked and \
+              unchecked[0].result is not None and \
+              unchecked[0].result.ready():
+            article = unchecked.popleft()
+
+            if not article.checked:
+                articles.append(article)
+
+        start_fetches(articles)
+
+    def submit_batch():
+        markdowns = [markdown for markdown, _ in batch]
+
+        if pool is None:
+            result = FinishedResult([(airport, None)
+                                     for airport in parse_airports(markdowns)])
+        else:
+            result = BatchResult(pool,
+                                 markdowns,
+                                 [article.title for _, article in batch])
+
+        for position, (_, article) in enumerate(batch):
+            article.result, article.position = result, position
+
+        del batch[:]
+
+    def write_results(f, limit=0):
+        while len(pending) > limit:
+            if pending[0].result is None:
+                submit_batch()
+
+            article = pending.popleft()
+            airport, error = article.get()
+
+            if not article.checked:
+                start_fetches([article])
+
+            fetch_failed = False
+
+            if article.fetch is not None:
+                passenger_numbers = article.fetch.get()
+                fetch_failed = passenger_numbers is None
+
+                if passenger_numbers:
+                    airport['passengers'] = passenger_numbers
+
+            if error is not None:
+                print >> sys.stderr, 'Line %d (%s) failed: %s' % (
+                    article.index,
+                    article.title,
+                    error)
+            elif article.cache_key is not None and not fetch_failed:
+                # Articles whose page couldn't be fetched are parsed again
+                # next time so the fetch is retried
+                cache.set(article.cache_key, airport)
+
+            if airport:
+                airport['title'] = article.title
+
+            write_airport(f, airport)
+            commit(f, article.index, article.offset)
+            stats['articles'] += 1
+
+    try:
+        with codecs.open(out_file, 'a+b', 'utf8') as f:
+            for index, offset, title, markdown in \
+                    read_wikipedia_pages(in_file,
+                                         start_on_line,
+                                         start_offset):
+                if index and not index % 100:
+                    print 'Line %d, %d of %d bytes (%.1f%%)' % (
+                        index,
+                        offset,
+                        in_file_size,
+                        100.0 * offset / max(in_file_size, 1))
+
+                article = PendingArticle(index, offset, title)
+                pending.append(article)
+
+                if cache is not None:
+                    cache_key = ArticleCache.get_key(markdown)
+                    found, airport = cache.get(cache_key)
+
+                    if found:
+                        article.result = FinishedResult([(airport, None)])
+                        article.checked = True
+                        continue
+
+                    article.cache_key = cache_key
+
+                batch.append((markdown, article))
+                unchecked.append(article)
+
+                if len(batch) >= batch_size:
+                    submit_batch()
+
+                start_ready_fetches()
+                write_results(f, max_pending)
+                report_stats()
+
+            write_results(f)
+            report_stats(force=True)
+
+            if last_written:
+                commit(f, force=True, **last_written)
+
+        if cache is not None:
+            print 'Cache: %d hits, %d misses' % (cache.counts['hits'],
+                                                 cache.counts['misses'])
+
+        if page_cache is not None:
+            print 'Page cache: %d hits, %d misses' % (
+                page_cache.counts['hits'],
+                page_cache.counts['misses'])
+
+        print_parser_counts()
+    except:
+        if pool is not None:
+            pool.terminate()
+
+        fetcher.terminate()
+        raise
+    else:
+        fetcher.close()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        if profile_dir is not None:
+            dump_profiles(profile_dir)
+            merge_profiles(profile_dir)
+
+
+def apply_changes(stats_file, changes_file, delta_file):
+    """
+    Rewrite stats_file without the airports of the pages updated or deleted
+    in changes_file and with the airports plucked from the changed pages in
+    delta_file added to the end.
+
+    :returns: the number of airports removed and added
+    :rtype: Counter
+    """
+    counts = Counter()
+
+    with open(changes_file, 'r+b') as f:
+        changed = {json.loads(line)['title'] for line in f if line.strip()}
+
+    temp_file = stats_file + '.tmp'
+
+    with open(temp_file, 'w+b') as out_file:
+        if os.path.exists(stats_file):
+            with open(stats_file, 'r+b') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+
+                    if json.loads(line).get('title') in changed:
+                        counts['removed'] += 1
+                        continue
+
+                    out_file.write(line.rstrip('\n') + '\n')
+
+        with open(delta_file, 'r+b') as f:
+            for line in f:
+                if line.strip():
+                    out_file.write(line.rstrip('\n') + '\n')
+                    counts['added'] += 1
+
+    os.rename(temp_file, stats_file)
+
+    return counts
+
+
+def update_airport_meta_data(in_file, out_file, changes_file, **kwargs):
+    """
+    Pluck the changed pages extracted by an incremental
+    get_wikipedia_content run and apply them to an existing stats file. The
+    changed pages are plucked into <out_file>.delta first so an interrupted
+    run can be resumed like any other. The checkpoint of the run that wrote
+    the stats file is moved to the new end of the file so a later plain run
+    neither truncates it nor plucks the whole extract again.
+
+    >>> directory = tempfile.mkdtemp()
+    >>> def write_extract(name, pages):
+    ...     with codecs.open(os.path.join(directory, name), 'w+b', 'utf8') \\
+    ...             as f:
+    ...         for title, text in pages:
+    ...             write_json_page(f, title, text)
+    ...     return f.name
+    >>> cache = ArticleCache(':memory:')
+    >>> for text in u'abcde':
+    ...     cache.set(ArticleCache.get_key(text),
+    ...               {'iata': text.upper() * 3, 'passengers': {}})
+    >>> extract = write_extract('extract.json',
+    ...                         [(u'A', u'a'), (u'B', u'b'), (u'C', u'c')])
+    >>> changed = write_extract('changed.json', [(u'B', u'd'), (u'D', u'e')])
+    >>> with open(os.path.join(directory, 'changes'), 'w+b') as changes:
+    ...     changes.write('{"change": "update", "title": "B"}\\n'
+    ...                   '{"change": "add", "title": "D"}\\n')
+    >>> stats = os.path.join(directory, 'stats.json')
+    >>> pluck_airport_meta_data(extract, stats, cache=cache)
+    ... # doctest: +ELLIPSIS
+    Cache: 3 hits, 0 misses
+    HTML parsed with: ...
+    >>> update_airport_meta_data(changed, stats, changes.name, cache=cache)
+    ... # doctest: +ELLIPSIS
+    Cache: 5 hits, 0 misses
+    HTML parsed with: ...
+    Stats: 1 airports removed, 2 added
+    >>> pluck_airport_meta_data(extract, stats, cache=cache)
+    ... # doctest: +ELLIPSIS
+    Resuming from line 4
+    Cache: 5 hits, 0 misses
+    HTML parsed with: ...
+    >>> with open(stats, 'r+b') as f:
+    ...     [json.loads(line)['title'] for line in f]
+    [u'A', u'C', u'B', u'D']
+    >>> shutil.rmtree(directory)
+    """
+    delta_file = out_file + '.delta'
+    pluck_airport_meta_data(in_file, delta_file, **kwargs)
+    counts = apply_changes(out_file, changes_file, delta_file)
+
+    for file_name in (delta_file, delta_file + '.checkpoint'):
+        if os.path.exists(file_name):
+            os.unlink(file_name)
+
+    checkpoint_file = out_file + '.checkpoint'
+
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file, 'r+b') as f:
+            checkpoint = json.load(f)
+
+        checkpoint['output_size'] = os.path.getsize(out_file)
+        save_checkpoint(checkpoint_file, checkpoint)
+
+    print 'Stats: %d airports removed, %d added' % (counts['removed'],
+                                                    counts['added'])
+
+
+"""
+Packed extract format
+"""
+# A packed extract is the magic string followed by one frame per article.
+# Each frame is the size of the title and of the compressed text, the UTF-8
+# title and the zlib compressed UTF-8 text. The <file>.idx index holds the
+# offset and title of every frame.
+PACKED_MAGIC = 'APEXTRACT1\n'
+PACKED_FRAME = struct.Struct('>II')
+PACKED_INDEX_MAGIC = 'APINDEX1\n'
+PACKED_INDEX_HEADER = struct.Struct('>QQ')
+EXTRACT_FORMATS = ('json', 'packed')
+
+
+def is_packed_file(file_name):
+    with open(file_name, 'rb') as f:
+        return f.read(len(PACKED_MAGIC)) == PACKED_MAGIC
+
+
+def pack_page(title, text):
+    """
+    >>> frame = pack_page(u'Heathrow Airport', u'Passengers 75,000,000')
+    >>> unpack_page(frame, 0) == (u'Heathrow Airport',
+    ...                           u'Passengers 75,000,000',
+    ...                           len(frame))
+    True
+    """
+    title = title.encode('utf8')
+    text = zlib.compress(text.encode('utf8'))
+    return PACKED_FRAME.pack(len(title), len(text)) + title + text
+
+
+def unpack_page(data, offset):
+    """
+    :returns: the title, the text and the offset the frame ends at
+    :rtype: tuple
+    """
+    title_size, text_size = PACKED_FRAME.unpack_from(data, offset)
+    start = offset + PACKED_FRAME.size
+    end = start + title_size + text_size
+
+    return data[start:start + title_size].decode('utf8'), \
+           zlib.decompress(data[start + title_size:end]).decode('utf8'), \
+           end
+
+
+def write_json_page(out_file, title, text):
+    out_file.write(json.dumps([title, text], ensure_ascii=False))
+    out_file.write('\n')
+
+
+def write_packed_page(out_file, title, text):
+    out_file.write(pack_page(title, text))
+
+
+def open_extract(file_name, extract_format, mode='a+b'):
+    if extract_format == 'json':
+        return codecs.open(file_name, mode, 'utf8')
+
+    return open(file_name, mode)
+
+
+def prepare_extract(file_name, extract_format):
+    """
+    Make sure an extract being appended to is in the format asked for and
+    start new packed extracts with the magic string.
+
+    :rtype: bool
+    """
+    if os.path.exists(file_name) and os.path.getsize(file_name):
+        return is_packed_file(file_name) == (extract_format == 'packed')
+
+    if extract_format == 'packed':
+        with open(file_name, 'w+b') as f:
+            f.write(PACKED_MAGIC)
+
+    return True
+
+
+def write_packed_index(file_name):
+    offsets, titles = [], []
+
+    with open(file_name, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = len(PACKED_MAGIC)
+
+        # Only the titles are read, the texts are skipped over undecoded
+        while offset < len(data):
+            title_size, text_size = PACKED_FRAME.unpack_from(data, offset)
+            start = offset + PACKED_FRAME.size
+            offsets.append(offset)
+            titles.append(data[start:start + title_size].decode('utf8'))
+            offset = start + title_size + text_size
+
+        data.close()
+
+    temp_file = file_name + '.idx.tmp'
+
+    with open(temp_file, 'w+b') as f:
+        f.write(PACKED_INDEX_MAGIC)
+        f.write(PACKED_INDEX_HEADER.pack(os.path.getsize(file_name),
+                                         len(titles)))
+        f.write(struct.pack('>%dQ' % len(offsets), *offsets))
+        json.dump(titles, f)
+
+    os.rename(temp_file, file_name + '.idx')
+
+
+def load_packed_index(file_name):
+    """
+    Load the offsets and titles of a packed extract's frames. The index is
+    rebuilt if it's missing or doesn't cover the whole extract.
+
+    :returns: offsets and titles
+    :rtype: tuple
+    """
+    index_file = file_name + '.idx'
+
+    for attempt in range(2):
+        if os.path.exists(index_file):
+            with open(index_file, 'rb') as f:
+                magic = f.read(len(PACKED_INDEX_MAGIC))
+                header = f.read(PACKED_INDEX_HEADER.size)
+
+                if magic == PACKED_INDEX_MAGIC and \
+                   len(header) == PACKED_INDEX_HEADER.size:
+                    size, count = PACKED_INDEX_HEADER.unpack(header)
+
+                    if size == os.path.getsize(file_name):
+                        offsets = struct.unpack('>%dQ' % count,
+                                                f.read(8 * count))
+                        return offsets, json.load(f)
+
+        write_packed_index(file_name)
+
+    raise IOError('Unable to index %s' % file_name)
+
+
+class PackedExtract(object):
+    """
+    Random access to the articles in a packed extract by line number (1 is
+    the first article) or by title. The extract is memory mapped and only the
+    articles asked for are decompressed.
+    """
+
+    def __init__(self, file_name):
+        self.file = open(file_name, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets, self.titles = load_packed_index(file_name)
+        self.lines = {}
+
+        for line, title in enumerate(self.titles, start=1):
+            self.lines.setdefault(title, line)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def get(self, line):
+        """
+        :returns: the title, the text and the offset the article ends at
+        :rtype: tuple
+        """
+        return unpack_page(self.data, self.offsets[line - 1])
+
+    def find(self, title):
+        """
+        :returns: the text of the first article with this title or None
+        :rtype: unicode
+        """
+        line = self.lines.get(title)
+        return self.get(line)[1] if line is not None else None
+
+    def iter_pages(self, start_on_line=1):
+        for line in xrange(max(start_on_line, 1), len(self) + 1):
+            title, text, offset = self.get(line)
+            yield line, offset, title, text
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+def convert_extract(in_file, out_file, extract_format='json'):
+    """
+    Copy an extract, in either format, into another file in extract_format.
+    """
+    if not prepare_extract(out_file, extract_format):
+        print >> sys.stderr, '%s is not a %s extract' % (out_file,
+                                                         extract_format)
+        return
+
+    write_page = write_packed_page if extract_format == 'packed' \
+                 else write_json_page
+
+    with open_extract(out_file, extract_format) as f:
+        for _, _, title, text in read_wikipedia_pages(in_file):
+            write_page(f, title, text)
+
+    if extract_format == 'packed':
+        write_packed_index(out_file)
+
+
+"""
+Data harvesting methods
+"""
+BZ2_STREAM_HEADER = re.compile(r'BZh[1-9]1AY&SY')
+BZ2_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def get_stream_offsets(filename):
+    """
+    Multistream dumps come with an index listing the byte offset each bz2
+    stream starts at. When there is no index the archive is scanned for
+    stream headers instead. The 80-bit header is byte-aligned at the start of
+    every stream so a false positive in the middle of compressed data is not
+    a practical concern.
+    """
+    index_filename = re.sub(r'multistream(\d*)\.xml',
+                            r'multistream-index\1.txt',
+                            filename)
+
+    if index_filename != filename and os.path.exists(index_filename):
+        # The stream holding the <siteinfo> header isn't in the index
+        offsets = set([0])
+
+        with bz2.BZ2File(index_filename, 'rb') as index_file:
+            for line in index_file:
+                offsets.add(int(line.split(':', 1)[0]))
+
+        return sorted(offsets)
+
+    with open(filename, 'rb') as bz2_file:
+        dump = mmap.mmap(bz2_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            return [match.start()
+                    for match in BZ2_STREAM_HEADER.finditer(dump)]
+        finally:
+            dump.close()
+
+
+def get_stream_chunks(filename, offsets, chunk_size=BZ2_CHUNK_SIZE):
+    """
+    Group neighbouring bz2 streams into chunks of roughly chunk_size
+    compressed bytes so each decompression task is worth sending to a worker.
+    """
+    file_size = os.path.getsize(filename)
+    chunks, start = [], None
+
+    for offset in offsets + [file_size]:
+        if start is None:
+            start = offset
+        elif offset - start >= chunk_size or offset == file_size:
+            chunks.append((start, offset))
+            start = offset
+
+    return chunks
+
+
+def decompress_bz2_chunk(args):
+    filename, start, end = args
+
+    with open(filename, 'rb') as bz2_file:
+        bz2_file.seek(start)
+        data = bz2_file.read(end - start)
+
+    output = []
+
+    # BZ2Decompressor stops at the end of each stream and leaves the
+    # remaining streams in unused_data.
+    while data:
+        decompressor = bz2.BZ2Decompressor()
+        output.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+
+    return ''.join(output)
+
+
+class BZ2StreamReader(object):
+    """
+    File-like reader over a multistream bz2 archive. Chunks of streams are
+    decompressed by a pool of worker processes and handed back in file order
+    so the output can be fed straight into etree.iterparse.
+
+    >>> directory = tempfile.mkdtemp()
+    >>> file_name = os.path.join(directory,
+    ...                          'pages-multistream1.xml-p1p2.bz2')
+    >>> streams = [bz2.compress('<mediawiki>'),
+    ...            bz2.compress('<page>A</page>'),
+    ...            bz2.compress('<page>B</page></mediawiki>')]
+    >>> with open(file_name, 'wb') as f:
+    ...     f.write(''.join(streams))
+    >>> index = bz2.BZ2File(os.path.join(
+    ...     directory, 'pages-multistream-index1.txt-p1p2.bz2'), 'wb')
+    >>> index.write('%d:1:A\\n%d:2:B\\n' % (
+    ...     len(streams[0]), len(streams[0]) + len(streams[1])))
+    >>> index.close()
+    >>> offsets = get_stream_offsets(file_name)
+    >>> offsets == [0, len(streams[0]), len(streams[0]) + len(streams[1])]
+    True
+    >>> with BZ2StreamReader(file_name, offsets, workers=2) as reader:
+    ...     reader.read(11) + reader.read()
+    '<mediawiki><page>A</page><page>B</page></mediawiki>'
+    >>> with open_dump(file_name, block_workers=2) as dump:
+    ...     dump.read()
+    '<mediawiki><page>A</page><page>B</page></mediawiki>'
+    >>> shutil.rmtree(directory)
+    """
+
+    def __init__(self, filename, offsets, workers=1):
+        self.filename = filename
+        self.chunks = iter(get_stream_chunks(filename, offsets))
+        self.pool = Pool(processes=workers) if workers > 1 else None
+        self.pending = deque()
+        self.max_pending = workers * 2
+        self.buffer, self.position = '', 0
+        self.fill()
+
+    def fill(self):
+        if self.pool is None:
+            return
+
+        while len(self.pending) < self.max_pending:
+            try:
+                start, end = next(self.chunks)
+            except StopIteration:
+                break
+
+            self.pending.append(
+                self.pool.apply_async(decompress_bz2_chunk,
+                                      ((self.filename, start, end),)))
+
+    def next_chunk(self):
+        if self.pool is None:
+            try:
+                start, end = next(self.chunks)
+            except StopIteration:
+                return None
+
+            return decompress_bz2_chunk((self.filename, start, end))
+
+        if not self.pending:
+            return None
+
+        data = self.pending.popleft().get()
+        self.fill()
+        return data
+
+    def read(self, size=-1):
+        output = []
+
+        while size:
+            if self.position >= len(self.buffer):
+                data = self.next_chunk()
+
+                if data is None:
+                    break
+
+                self.buffer, self.position = data, 0
+
+            end = len(self.buffer) if size < 0 else self.position + size
+            data = self.buffer[self.position:end]
+            self.position += len(data)
+            output.append(data)
+
+            if size > 0:
+                size -= len(data)
+
+        return ''.join(output)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def is_multistream(filename):
+    return re.search(r'multistream\d*\.xml', filename) is not None
+
+
+def open_dump(filename, block_workers=1):
+    """
+    Python 2's BZ2File only reads the first stream of a multistream archive
+    so those are always read stream by stream, on block_workers processes.
+    Other dumps are a single stream and are decompressed serially whatever
+    block_workers is.
+    """
+    if is_multistream(filename):
+        offsets = get_stream_offsets(filename)
+
+        if len(offsets) > 1:
+            return BZ2StreamReader(filename, offsets, block_workers)
+
+    return bz2.BZ2File(filename, 'rb')
+
+
+def get_parser(filename, block_workers=1):
+    ns_token        = '{http://www.mediawiki.org/xml/export-0.10/}ns'
+    title_token     = '{http://www.mediawiki.org/xml/export-0.10/}title'
+    revision_token  = '{http://www.mediawiki.org/xml/export-0.10/}revision'
+    text_token      = '{http://www.mediawiki.org/xml/export-0.10/}text'
+
+    with open_dump(filename, block_workers) as bz2_file:
+        for event, element in etree.iterparse(bz2_file, events=('end',)):
+            if element.tag.endswith('page'):
+                namespace_tag = element.find(ns_token)
+
+                if namespace_tag.text == '0':
+                    title_tag = element.find(title_token)
+                    text_tag = element.find(revision_token).find(text_token)
+                    yield title_tag.text, text_tag.text
+
+                element.clear()
+
+
+def is_airport_title(title):
+    return 'airport' in title.lower()
+
+
+class DumpPageTarget(object):
+    """
+    lxml parser target which only keeps the text of pages whose title passes
+    title_filter. A page's title and namespace come before its revision so
+    the decision is made before any of the revision's text is seen and no
+    elements are built for the pages that are skipped. The revision's id and
+    sha1 are kept alongside the text.
+
+    Redirects to pages whose title passes title_filter are kept without their
+    text, with the title they redirect to in 'redirect'.
+    """
+
+    def __init__(self, title_filter, counts):
+        self.title_filter = title_filter
+        self.counts = counts
+        self.pages = []
+        self.page = None
+        self.wanted = None
+        self.in_revision = False
+        self.tag = None
+        self.chunks = []
+
+    def start(self, tag, attrib):
+        tag = tag.rsplit('}', 1)[-1]
+
+        if tag == 'page':
+            self.page, self.wanted = {}, None
+            return
+
+        if self.page is None:
+            return
+
+        if tag == 'redirect':
+            self.page['redirect'] = attrib.get('title', u'')
+
+        if tag == 'revision' and self.wanted is None:
+            title = self.page.get('redirect', self.page.get('title', u''))
+            self.wanted = self.page.get('ns') == '0' and \
+                          self.title_filter(title)
+
+            if not self.wanted:
+                self.counts['skipped'] += 1
+            elif 'redirect' in self.page:
+                self.counts['redirects'] += 1
+            else:
+                self.counts['kept'] += 1
+
+        if 'redirect' in self.page:
+            return
+
+        if tag == 'revision':
+            self.in_revision = True
+
+        # The first id in a revision is its own, the contributor's comes after
+        if tag in ('title', 'ns') or \
+           (tag in ('text', 'sha1') and self.wanted) or \
+           (tag == 'id' and self.wanted and self.in_revision and
+            'revision_id' not in self.page):
+            self.tag, self.chunks = tag, []
+
+    def data(self, data):
+        if self.tag is not None:
+            self.chunks.append(data)
+
+    def end(self, tag):
+        tag = tag.rsplit('}', 1)[-1]
+
+        if tag == self.tag:
+            self.page['revision_id' if tag == 'id' else tag] = \
+                u''.join(self.chunks)
+            self.tag, self.chunks = None, []
+        elif tag == 'revision':
+            self.in_revision = False
+        elif tag == 'page':
+            if self.wanted:
+                self.pages.append(self.page)
+
+            self.page = None
+
+    def close(self):
+        pass
+
+
+def get_filtered_parser(filename,
+                        title_filter=is_airport_title,
+                        counts=None,
+                        block_workers=1,
+                        read_size=1024 * 1024):
+    """
+    Yields the article pages (namespace 0) whose title passes title_filter,
+    and the redirects to them. The number of pages kept and skipped, and of
+    redirects kept, is added to counts.
+    """
+    counts = Counter() if counts is None else counts
+    target = DumpPageTarget(title_filter, counts)
+    parser = etree.XMLParser(target=target, huge_tree=True)
+
+    with open_dump(filename, block_workers) as bz2_file:
+        while True:
+            data = bz2_file.read(read_size)
+
+            if not data:
+                break
+
+            parser.feed(data)
+
+            for page in target.pages:
+                yield page
+
+            del target.pages[:]
+
+    parser.close()
+
+    for page in target.pages:
+        yield page
+
+
+def get_dump_files(pattern='enwiki-*-pages-articles*.xml-*.bz2'):
+    return sorted(glob(pattern),
+                  key=lambda a: int(
+                    re.search(r'articles(?:-multistream)?(\d+)', a).group(1)),
+                  reverse=True)
+
+
+def get_page_version(page):
+    """
+    :returns: what identifies this revision of the page's text
+    :rtype: unicode
+    """
+    if page.get('sha1'):
+        return page['sha1']
+
+    return u'revision:%s' % page.get('revision_id', u'')
+
+
+def load_manifest(manifest_file):
+    """
+    :returns: the version of each page extracted by the previous run
+    :rtype: dict
+    """
+    if not os.path.exists(manifest_file):
+        return {}
+
+    with open(manifest_file, 'r+b') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_file, versions):
+    temp_file = manifest_file + '.tmp'
+
+    with open(temp_file, 'w+b') as f:
+        json.dump(versions, f, sort_keys=True)
+
+    os.rename(temp_file, manifest_file)
+
+
+def get_changes(manifest, versions):
+    """
+    Compare the pages seen in this dump with the previous run's manifest.
+
+    :param dict manifest: the version of each page last time
+    :param list versions: the title and version of each page in dump order
+    :returns: the change and title of every page added, updated or deleted
+    :rtype: list
+
+    >>> get_changes({u'A': u'1', u'B': u'2', u'C': u'3'},
+    ...             [(u'A', u'1'), (u'C', u'4'), (u'D', u'5')])
+    [(u'update', u'C'), (u'add', u'D'), (u'delete', u'B')]
+    """
+    changes = []
+    seen = set()
+
+    for title, version in versions:
+        seen.add(title)
+
+        if title not in manifest:
+            changes.append((u'add', title))
+        elif manifest[title] != version:
+            changes.append((u'update', title))
+
+    changes.extend((u'delete', title)
+                   for title in sorted(manifest)
+                   if title not in seen)
+
+    return changes
+
+
+def write_wikipedia_titles_text(bz2_filename,
+                                out_file,
+                                block_workers=1,
+                                title_filter=is_airport_title,
+                                extract_format='json',
+                                manifest=None):
+    """
+    Write the pages whose title passes title_filter to out_file. When a
+    manifest from a previous run is given only pages whose version differs
+    from it are written.
+
+    :returns: the counts of pages kept and skipped, the title and version
+              of every page kept and the title and target of every redirect
+              to them
+    :rtype: tuple
+    """
+    counts, versions, redirects = Counter(), [], []
+    write_page = write_packed_page if extract_format == 'packed' \
+                 else write_json_page
+    parser = get_filtered_parser(bz2_filename,
+                                 title_filter=title_filter,
+                                 counts=counts,
+                                 block_workers=block_workers)
+
+    for page in parser:
+        if 'redirect' in page:
+            redirects.append((page['title'], page['redirect']))
+            continue
+
+        version = get_page_version(page)
+        versions.append((page['title'], version))
+
+        if manifest is not None and manifest.get(page['title']) == version:
+            counts['unchanged'] += 1
+            continue
+
+        write_page(out_file, page['title'], page.get('text', u''))
+
+    return counts, versions, redirects
+
+
+def print_extract_counts(bz2_filename, counts):
+    print '%s: %d pages kept, %d skipped, %d redirects%s' % (
+        bz2_filename,
+        counts['kept'],
+        counts['skipped'],
+        counts['redirects'],
+        ', %d unchanged' % counts['unchanged'] if counts['unchanged'] else '')
+
+
+def write_changes(changes_file, changes):
+    with codecs.open(changes_file, 'w+b', 'utf8') as f:
+        for change, title in changes:
+            f.write(json.dumps({'change': change, 'title': title},
+                               ensure_ascii=False,
+                               sort_keys=True))
+            f.write('\n')
+
+    print 'Changes: %d added, %d updated, %d deleted' % tuple(
+        sum(1 for change, _ in changes if change == kind)
+        for kind in ('add', 'update', 'delete'))
+
+
+def write_redirects(redirects_file, redirects):
+    with codecs.open(redirects_file, 'w+b', 'utf8') as f:
+        for title, target in redirects:
+            f.write(json.dumps({'title': title, 'target': target},
+                               ensure_ascii=False,
+                               sort_keys=True))
+            f.write('\n')
+
+
+def extract_wikipedia_titles_text(bz2_filename,
+                                  block_workers=1,
+                                  title_filter=is_airport_title,
+                                  extract_format='json',
+                                  manifest=None):
+    """
+    Worker process entry point. Extracts a single dump shard into a temporary
+    file and returns its name so the parent process can merge the shards in
+    order. Packed shards are written without the magic string.
+    """
+    output_file = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+    file_name = output_file.name
+    output_file.close()
+
+    with open_extract(file_name, extract_format, 'w+b') as out_file:
+        counts, versions, redirects = write_wikipedia_titles_text(
+            bz2_filename,
+            out_file,
+            block_workers,
+            title_filter,
+            extract_format,
+            manifest)
+
+    return file_name, counts, versions, redirects
+
+
+def finish_extract(out_file, extract_format, manifest_file, manifest,
+                   versions, redirects):
+    if extract_format == 'packed':
+        write_packed_index(out_file)
+
+    write_redirects(out_file + '.redirects', redirects)
+
+    if manifest_file is not None:
+        write_changes(out_file + '.changes', get_changes(manifest, versions))
+        save_manifest(manifest_file, dict(versions))
+
+
+def pluck_wikipedia_titles_text(pattern='enwiki-*-pages-articles*.xml-*.bz2',
+                               out_file='airport_markdown.json',
+                               workers=1,
+                               block_workers=1,
+                               title_filter=is_airport_title,
+                               extract_format='json',
+                               manifest_file=None):
+    """
+    Extract the pages whose title passes title_filter from every dump shard.
+    With a manifest_file only the pages added or changed since the run that
+    wrote the manifest are extracted, into a fresh out_file, and every page
+    added, updated or deleted is listed in out_file.changes. Every redirect
+    to the pages is listed in out_file.redirects.
+    """
+    bz2_filenames = get_dump_files(pattern)
+    manifest, versions, redirects = None, [], []
+
+    if manifest_file is not None:
+        manifest = load_manifest(manifest_file)
+
+        if os.path.exists(out_file):
+            os.unlink(out_file)
+
+    if not prepare_extract(out_file, extract_format):
+        print >> sys.stderr, '%s is not a %s extract' % (out_file,
+                                                         extract_format)
+        return
+
+    if workers < 2:
+        with open_extract(out_file, extract_format) as f:
+            for bz2_filename in bz2_filenames:
+                counts, shard_versions, shard_redirects = \
+                    write_wikipedia_titles_text(bz2_filename,
+                                                f,
+                                                block_workers,
+                                                title_filter,
+                                                extract_format,
+                                                manifest)
+                versions.extend(shard_versions)
+                redirects.extend(shard_redirects)
+                print_extract_counts(bz2_filename, counts)
+
+        finish_extract(out_file, extract_format, manifest_file, manifest,
+                       versions, redirects)
+        return
+
+    # The largest shard sets the runtime of a parallel run. When block level
+    # decompression is enabled the largest multistream shard is extracted in
+    # this process, which unlike the pool's daemonic workers is allowed to
+    # start its own worker pool.
+    largest = None
+    multistream_filenames = filter(is_multistream, bz2_filenames)
+
+    if block_workers > 1 and multistream_filenames:
+        largest = max(multistream_filenames, key=os.path.getsize)
+
+    pool = Pool(processes=workers)
+
+    try:
+        shards = {bz2_filename: pool.apply_async(extract_wikipedia_titles_text,
+                                                 (bz2_filename,
+                                                  1,
+                                                  title_filter,
+                                                  extract_format,
+                                                  manifest))
+                  for bz2_filename in bz2_filenames
+                  if bz2_filename != largest}
+
+        if largest is not None:
+            largest_shard = extract_wikipedia_titles_text(largest,
+                                                          block_workers,
+                                                          title_filter,
+                                                          extract_format,
+                                                          manifest)
+
+        # Shards are merged in the same order as a single process run so the
+        # output file is identical.
+        with open(out_file, 'a+b') as f:
+            for bz2_filename in bz2_filenames:
+                if bz2_filename == largest:
+                    shard_file_name, counts, shard_versions, \
+                        shard_redirects = largest_shard
+                else:
+                    shard_file_name, counts, shard_versions, \
+                        shard_redirects = shards[bz2_filename].get()
+
+                versions.extend(shard_versions)
+                redirects.extend(shard_redirects)
+                print_extract_counts(bz2_filename, counts)
+
+                with open(shard_file_name, 'rb') as shard_file:
+                    shutil.copyfileobj(shard_file, f)
+
+                os.unlink(shard_file_name)
+
+        finish_extract(out_file, extract_format, manifest_file, manifest,
+                       versions, redirects)
+
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+"""
+Application control methods
+"""
+def main(argv):
+    """
+    :param dict argv: command line arguments
+    """
+    opt = docopt(__doc__, argv)
+
+    if opt['test']:
+        import doctest
+        doctest.testmod()
+        return
+
+    if opt['--format'] not in EXTRACT_FORMATS:
+        print >> sys.stderr, '--format must be one of %s' % \
+            ', '.join(EXTRACT_FORMATS)
+        return
+
+    if opt['get_wikipedia_content']:
+        pluck_wikipedia_titles_text(out_file=opt['<output_file>'],
+                                    pattern=opt['--pattern'],
+                                    workers=int(opt['--workers']),
+                                    block_workers=int(opt['--block-workers']),
+                                    extract_format=opt['--format'],
+                                    manifest_file=opt['--manifest'])
+        return
+
+    if opt['convert_extract']:
+        convert_extract(opt['<input_file>'],
+                        opt['<output_file>'],
+                        extract_format=opt['--format'])
         return
 
     if opt['pluck_airport_meta_data']:
-        pluck_airport_meta_data(in_file=opt['<input_file>'],
-                                out_file=opt['<output_file>'],
-                                start_on_line=int(opt['--start']))
+        if opt['--html-parser'] not in HTML_PARSERS:
+            print >> sys.stderr, '--html-parser must be one of %s' % \
+                ', '.join(HTML_PARSERS)
+            return
+
+        set_html_parser(opt['--html-parser'])
+        set_time_budget(float(opt['--time-budget']))
+        cache = None
+
+        if opt['--cache']:
+            cache = ArticleCache(opt['--cache'],
+                                 int(opt['--cache-size']) * 1024 * 1024)
+
+            if opt['--clear-cache']:
+                cache.clear()
+
+        kwargs = {
+            'start_on_line': int(opt['--start']) if opt['--start'] else None,
+            'workers': int(opt['--workers']),
+            'cache': cache,
+            'batch_size': int(opt['--batch-size']),
+            'fetcher': WikipediaFetcher(opt['--wikipedia-url'],
+                                        threads=int(opt['--fetch-threads'])),
+            'page_cache': open_page_cache(
+                opt['--page-cache'],
+                int(opt['--page-cache-ttl']) * 86400),
+            'stats_file': opt['--stats'],
+            'stats_every': int(opt['--stats-every']),
+            'profile_dir': opt['--profile'],
+        }
+
+        try:
+            if opt['--changes']:
+                update_airport_meta_data(opt['<input_file>'],
+                                         opt['<output_file>'],
+                                         opt['--changes'],
+                                         **kwargs)
+            else:
+                pluck_airport_meta_data(opt['<input_file>'],
+                                        opt['<output_file>'],
+                                        **kwargs)
+        finally:
+            if cache is not None:
+                cache.close()
         return
 
 
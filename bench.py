@@ -0,0 +1,493 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+"""
+Commercial Airline Passenger Numbers Benchmarks
+
+Usage:
+    ./bench.py generate <corpus_dir> [--articles=<num>] [--seed=<num>]
+    ./bench.py run [<benchmark>...] [--articles=<num>] [--seed=<num>]
+                   [--corpus=<dir>] [--baseline=<file>] [--save-baseline]
+                   [--tolerance=<pct>]
+    ./bench.py measure <benchmark> <corpus_dir>
+    ./bench.py (-h | --help)
+
+Options:
+    -h, --help          Show this screen and exit.
+    --articles=<num>    Number of articles of each kind in the corpus
+                        [Default: 200]
+    --seed=<num>        Seed the corpus is generated from [Default: 1]
+    --corpus=<dir>      Where the corpus is kept, it's generated if missing
+                        [Default: bench_corpus]
+    --baseline=<file>   Results to compare against
+                        [Default: bench_baseline.json]
+    --save-baseline     Store this run's results as the new baseline
+    --tolerance=<pct>   How much slower, or bigger, a benchmark can get before
+                        it's reported as a regression [Default: 10]
+"""
+import bz2
+import codecs
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+
+"""
+Synthetic corpus methods
+"""
+SYLLABLES = ('ka', 'lo', 'ran', 'vi', 'sto', 'mu', 'pel', 'dor', 'an', 'que',
+             'zi', 'bar', 'hol', 'ne', 'tam', 'ri', 'os', 'lin', 'ge', 'wa')
+
+# Lists nested this deep are past the recursion limit of the markdown and
+# soup code.
+DEEP_NESTING = 600
+
+
+def make_airports(rand, count):
+    """
+    :returns: the name, IATA code, latitude and longitude of count airports
+    :rtype: list
+    """
+    airports, iatas = [], set()
+
+    while len(airports) < count:
+        name = ''.join(rand.choice(SYLLABLES)
+                       for _ in range(rand.randint(2, 4))).title()
+        iata = ''.join(rand.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+                       for _ in range(3))
+
+        if iata in iatas:
+            continue
+
+        iatas.add(iata)
+        airports.append(('%s International Airport' % name,
+                         iata,
+                         rand.uniform(-60, 70),
+                         rand.uniform(-180, 180)))
+
+    return airports
+
+
+def format_dms(value, positive, negative):
+    """
+    >>> format_dms(-12.5125, 'N', 'S')
+    (12, 30, 45, 'S')
+    """
+    hemisphere = positive if value >= 0 else negative
+    seconds = int(round(abs(value) * 3600))
+    return seconds // 3600, seconds // 60 % 60, seconds % 60, hemisphere
+
+
+def make_infobox(airport):
+    name, iata, latitude, longitude = airport
+    latd, latm, lats, latNS = format_dms(latitude, 'N', 'S')
+    longd, longm, longs, longEW = format_dms(longitude, 'E', 'W')
+
+    return u'\n'.join((
+        u'{{Infobox airport',
+        u'| name = %s<ref>{{cite web|url=http://example.com}}</ref>' % name,
+        u'| IATA = %s' % iata,
+        u'| ICAO = K%s' % iata,
+        u'| latd = %d | latm = %d | lats = %d | latNS = %s' % (latd, latm,
+                                                              lats, latNS),
+        u'| longd = %d | longm = %d | longs = %d | longEW = %s' % (
+            longd, longm, longs, longEW),
+        u'}}',
+    ))
+
+
+def make_route_table(rand, airports, rows):
+    lines = [u'== Busiest routes ==', u'|=Rank|=Airport|=Passengers|']
+
+    for rank, airport in enumerate(rand.sample(airports,
+                                               min(rows, len(airports))),
+                                   start=1):
+        passengers = rand.randint(1000, 9999999)
+        lines.append(u'|%d|[[%s]]|{:,}|'.format(passengers) % (rank,
+                                                              airport[0]))
+
+    return u'\n'.join(lines)
+
+
+def make_article(rand, airport, airports, kind):
+    """
+    :param str kind: small, large or deep
+    """
+    parts = [make_infobox(airport),
+             u"'''%s''' is an airport serving the city of %s." % (
+                airport[0], airport[0].split()[0])]
+
+    if kind == 'small':
+        parts.append(make_route_table(rand, airports, 10))
+    elif kind == 'large':
+        parts.append(u'\n\n'.join(u'Paragraph %d about the terminals.' % index
+                                  for index in range(50)))
+        parts.append(make_route_table(rand, airports, 500))
+    else:
+        parts.append(u'\n'.join(u'%s Level %d' % ('*' * depth, depth)
+                                for depth in range(1, DEEP_NESTING)))
+        parts.append(u'{{a|' * DEEP_NESTING + u'x' + u'}}' * DEEP_NESTING)
+        parts.append(make_route_table(rand, airports, 10))
+
+    return u'\n\n'.join(parts)
+
+
+def make_page_xml(title, text, ns=0):
+    return u''.join((
+        u'<page><title>%s</title><ns>%d</ns><id>1</id>' % (
+            xml_escape(title), ns),
+        u'<revision><id>2</id><text>%s</text><sha1>x</sha1></revision>' % (
+            xml_escape(text)),
+        u'</page>\n',
+    ))
+
+
+def xml_escape(text):
+    return text.replace(u'&', u'&amp;') \
+               .replace(u'<', u'&lt;') \
+               .replace(u'>', u'&gt;')
+
+
+def generate_corpus(corpus_dir, articles=200, seed=1):
+    """
+    Write a reproducible corpus of synthetic articles to corpus_dir:
+
+    articles.json: small, large and deeply nested airport articles in the
+    format get_wikipedia_content writes.
+    dump.xml.bz2: the same articles, and as many other pages, as a dump.
+    stats.json: airports and passenger numbers in the format
+    pluck_airport_meta_data writes.
+    """
+    rand = random.Random(seed)
+    airports = make_airports(rand, articles * 3)
+
+    if not os.path.isdir(corpus_dir):
+        os.makedirs(corpus_dir)
+
+    pages = [(airport[0], make_article(rand, airport, airports, kind))
+             for kind, chunk in zip(('small', 'large', 'deep'),
+                                    (airports[:articles],
+                                     airports[articles:articles * 2],
+                                     airports[articles * 2:]))
+             for airport in chunk]
+    rand.shuffle(pages)
+
+    with codecs.open(os.path.join(corpus_dir, 'articles.json'),
+                     'w+b',
+                     'utf8') as f:
+        for title, text in pages:
+            f.write(json.dumps([title, text], ensure_ascii=False))
+            f.write('\n')
+
+    dump = bz2.BZ2File(os.path.join(corpus_dir, 'dump.xml.bz2'), 'w')
+    dump.write('<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/">'
+               '\n')
+
+    for index, (title, text) in enumerate(pages):
+        dump.write(make_page_xml(title, text).encode('utf8'))
+        dump.write(make_page_xml(u'Town %d' % index,
+                                 u'Not an airport. ' * 200).encode('utf8'))
+
+    dump.write('</mediawiki>\n')
+    dump.close()
+
+    with open(os.path.join(corpus_dir, 'stats.json'), 'w+b') as f:
+        for name, iata, latitude, longitude in airports:
+            url = '/wiki/' + name.replace(' ', '_')
+            passengers = {'/wiki/' + other[0].replace(' ', '_'):
+                          rand.randint(1000, 9999999)
+                          for other in rand.sample(airports,
+                                                   min(20, len(airports)))}
+            f.write(json.dumps({
+                'airport_name': name,
+                'iata': iata,
+                'latitude': latitude,
+                'longitude': longitude,
+                'passengers': passengers,
+                'title': name,
+                'url': url,
+            }, sort_keys=True))
+            f.write('\n')
+
+    with open(os.path.join(corpus_dir, 'corpus.json'), 'w+b') as f:
+        json.dump({'articles': articles, 'seed': seed}, f)
+
+
+"""
+Benchmark methods
+"""
+def bench_get_parser(corpus_dir):
+    from app import get_parser
+    return sum(1 for _ in get_parser(os.path.join(corpus_dir,
+                                                  'dump.xml.bz2')))
+
+
+def bench_get_filtered_parser(corpus_dir):
+    from app import get_filtered_parser
+    return sum(1 for _ in get_filtered_parser(os.path.join(corpus_dir,
+                                                           'dump.xml.bz2')))
+
+
+def bench_pluck_passenger_numbers(corpus_dir):
+    from app import markdown_to_soup, pluck_passenger_numbers
+
+    with open(os.path.join(corpus_dir, 'articles.json'), 'r+b') as f:
+        markdowns = [json.loads(line)[1] for line in f]
+
+    # Only the plucking is timed, not rendering the articles. The deeply
+    # nested articles are left out as they can't be rendered.
+    soups = [soup
+             for soup in (markdown_to_soup(markdown)
+                          for markdown in markdowns
+                          if markdown.count('\n*') < 10)
+             if soup is not None]
+
+    start = time.time()
+
+    for soup in soups:
+        pluck_passenger_numbers(soup)
+
+    return len(soups), time.time() - start
+
+
+def bench_pluck_airport_meta_data(corpus_dir):
+    from app import pluck_airport_meta_data, serve_stub_pages, \
+                    WikipediaFetcher
+
+    out_dir = tempfile.mkdtemp()
+    server = serve_stub_pages({})
+
+    try:
+        # Fetches get a quick 404 from the stand-in server
+        fetcher = WikipediaFetcher('http://127.0.0.1:%d' % server.server_port,
+                                   max_calls=1000000,
+                                   period=1)
+        pluck_airport_meta_data(os.path.join(corpus_dir, 'articles.json'),
+                                os.path.join(out_dir, 'stats.json'),
+                                start_on_line=1,
+                                fetcher=fetcher)
+    finally:
+        server.shutdown()
+        shutil.rmtree(out_dir)
+
+    with open(os.path.join(corpus_dir, 'articles.json'), 'r+b') as f:
+        return sum(1 for _ in f)
+
+
+def bench_get_pairs_and_volumes(corpus_dir):
+    from plot import iter_airports, get_pairs_and_volumes
+    pairs, iatas = get_pairs_and_volumes(
+        iter_airports(os.path.join(corpus_dir, 'stats.json')))
+    return len(iatas)
+
+
+def bench_save_map(corpus_dir):
+    from plot import load_airports, get_pairs_and_volumes, \
+                     make_route_store, get_route_tiers, save_map
+    airports = load_airports(os.path.join(corpus_dir, 'stats.json'))
+    store = make_route_store(*get_pairs_and_volumes(airports))
+    out_dir = tempfile.mkdtemp()
+
+    try:
+        start = time.time()
+        save_map(get_route_tiers(store), [os.path.join(out_dir, 'map.png')])
+        return len(store['passengers']), time.time() - start
+    finally:
+        shutil.rmtree(out_dir)
+
+
+BENCHMARKS = (
+    ('get_parser', bench_get_parser),
+    ('get_filtered_parser', bench_get_filtered_parser),
+    ('pluck_passenger_numbers', bench_pluck_passenger_numbers),
+    ('pluck_airport_meta_data', bench_pluck_airport_meta_data),
+    ('get_pairs_and_volumes', bench_get_pairs_and_volumes),
+    ('save_map', bench_save_map),
+)
+
+
+def measure(name, corpus_dir):
+    """
+    Run a single benchmark in this process. Benchmarks return the number of
+    items they processed and optionally the seconds spent on the part being
+    measured, if that isn't the whole benchmark.
+
+    :returns: the items processed, seconds taken and peak RSS
+    :rtype: dict
+    """
+    start = time.time()
+    result = dict(BENCHMARKS)[name](corpus_dir)
+    seconds = time.time() - start
+
+    if isinstance(result, tuple):
+        result, seconds = result
+
+    return {
+        'items': result,
+        'seconds': round(seconds, 4),
+        'rate': round(result / max(seconds, 0.0001), 2),
+        # Linux reports the peak RSS in kilobytes
+        'peak_rss_mb': round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+    }
+
+
+def run_benchmark(name, corpus_dir):
+    """
+    Run a benchmark in a fresh interpreter so its peak RSS isn't inflated by
+    the benchmarks that ran before it.
+
+    :returns: the benchmark's measurements or the error it failed with
+    :rtype: dict
+    """
+    process = subprocess.Popen([sys.executable,
+                                os.path.abspath(__file__),
+                                'measure',
+                                name,
+                                corpus_dir],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    stdout, stderr = process.communicate()
+
+    if process.returncode:
+        return {'error': stderr.strip().split('\n')[-1] or
+                         'exit %d' % process.returncode}
+
+    # The benchmarked code may print progress, the results are last
+    return json.loads(stdout.strip().split('\n')[-1])
+
+
+def compare(result, baseline, tolerance):
+    """
+    :returns: how the result differs from the baseline and whether that's a
+              regression
+    :rtype: tuple
+
+    >>> compare({'rate': 90, 'peak_rss_mb': 100},
+    ...         {'rate': 100, 'peak_rss_mb': 100}, 5)
+    ('rate -10.0%, rss +0.0%', True)
+    """
+    if not baseline or 'error' in baseline or 'error' in result:
+        return '', False
+
+    rate = 100.0 * (result['rate'] - baseline['rate']) / \
+           max(baseline['rate'], 0.0001)
+    rss = 100.0 * (result['peak_rss_mb'] - baseline['peak_rss_mb']) / \
+          max(baseline['peak_rss_mb'], 0.0001)
+
+    return 'rate %+.1f%%, rss %+.1f%%' % (rate, rss), \
+           rate < -tolerance or rss > tolerance
+
+
+def run_benchmarks(names,
+                   corpus_dir,
+                   baseline_file,
+                   save_baseline=False,
+                   tolerance=10,
+                   articles=200,
+                   seed=1):
+    """
+    :returns: whether any benchmark regressed compared to the baseline
+    :rtype: bool
+    """
+    corpus = {'articles': articles, 'seed': seed}
+    corpus_file = os.path.join(corpus_dir, 'corpus.json')
+
+    if not os.path.exists(corpus_file) or \
+       json.load(open(corpus_file, 'r+b')) != corpus:
+        print 'Generating corpus in %s' % corpus_dir
+        generate_corpus(corpus_dir, articles, seed)
+
+    baseline = {}
+
+    if os.path.exists(baseline_file):
+        with open(baseline_file, 'r+b') as f:
+            baseline = json.load(f)
+
+        if baseline.get('corpus') != corpus:
+            print 'Baseline was measured on a different corpus, ignoring it'
+            baseline = {}
+
+    results, regressed = {'corpus': corpus}, False
+
+    for name in names:
+        result = run_benchmark(name, os.path.abspath(corpus_dir))
+        results[name] = result
+        change, regression = compare(result,
+                                     baseline.get(name),
+                                     tolerance)
+        regressed = regressed or regression
+
+        if 'error' in result:
+            print '%-24s failed: %s' % (name, result['error'])
+        else:
+            print '%-24s %8d items %9.3fs %11.1f/s %8.1f MB %s%s' % (
+                name,
+                result['items'],
+                result['seconds'],
+                result['rate'],
+                result['peak_rss_mb'],
+                change,
+                ' REGRESSION' if regression else '')
+
+    if save_baseline:
+        baseline.update(results)
+
+        with open(baseline_file, 'w+b') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+
+    return regressed
+
+
+"""
+Application control methods
+"""
+def main(argv):
+    """
+    :param dict argv: command line arguments
+    """
+    opt = docopt(__doc__, argv)
+
+    if opt['generate']:
+        generate_corpus(opt['<corpus_dir>'],
+                        int(opt['--articles']),
+                        int(opt['--seed']))
+        return
+
+    if opt['measure']:
+        print json.dumps(measure(opt['<benchmark>'][0], opt['<corpus_dir>']))
+        return
+
+    if opt['run']:
+        names = opt['<benchmark>'] or [name for name, _ in BENCHMARKS]
+        unknown = set(names) - set(dict(BENCHMARKS))
+
+        if unknown:
+            print >> sys.stderr, 'Unknown benchmarks: %s, pick from %s' % (
+                ', '.join(sorted(unknown)),
+                ', '.join(name for name, _ in BENCHMARKS))
+            sys.exit(2)
+
+        if run_benchmarks(names,
+                          opt['--corpus'],
+                          opt['--baseline'],
+                          save_baseline=opt['--save-baseline'],
+                          tolerance=float(opt['--tolerance']),
+                          articles=int(opt['--articles']),
+                          seed=int(opt['--seed'])):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except KeyboardInterrupt:
+        pass
@@ -4,11 +4,26 @@
 Commercial Airline Passenger Numbers Rendering Tool
 
 Usage:
-    ./plot.py render <stats_file> <image_file>
+    ./plot.py render <stats_file> <image_file>... [--variants=<file>]
+                     [--dpi=<dpi>] [--workers=<num>] [--tile-size=<rows>]
+                     [--background-cache=<dir>] [--redirects=<file>]
+    ./plot.py compile <stats_file> <store_dir> [--redirects=<file>]
+    ./plot.py test
     ./plot.py (-h | --help)
 
 Options:
     -h, --help   Show this screen and exit.
+    --variants=<file>  JSON list of map variants to render each image file
+                 as, see load_variants
+    --dpi=<dpi>  Dots per inch of the images [Default: 1000]
+    --workers=<num>  Number of processes to render variants with
+                 [Default: 1]
+    --tile-size=<rows>  Most pixel rows of a PNG drawn at a time
+                 [Default: 2048]
+    --background-cache=<dir>  Where to cache the rendered background
+                 [Default: .background_cache]
+    --redirects=<file>  Redirects written by app.py get_wikipedia_content
+                 to resolve route URLs with
 """
 import matplotlib as mpl
 
@@ -19,12 +34,49 @@ mpl.use('Agg') # This needs to be called before mpl_toolkits is imported
 from docopt import docopt
 from mpl_toolkits.basemap import Basemap
 import numpy as np
+from matplotlib.collections import LineCollection
 import matplotlib.pyplot as plt
+from unidecode import unidecode
 
 import codecs
+from hashlib import sha1
 import json
 import math
+from multiprocessing import Pool
+import os
+import struct
 import sys
+from urllib import unquote
+import zlib
+
+
+# Basemap's radius of the earth in kilometres
+EARTH_RADIUS = 6370.997
+
+BACKGROUND_IMAGE = 'earth_lights_lrg.jpg'
+FIGURE_SIZE = (7.195, 3.841)
+
+# Routes are drawn in the style of the highest passenger threshold they reach
+DISPLAY_PARAMS = (
+    # color   alpha  width threshold
+    ('#e5cccf', 0.3, 0.2, 0),
+    ('#f7c4b1', 0.4, 0.3, 250000),
+    ('#ed8d75', 0.5, 0.4, 500000),
+    ('#ef684b', 0.6, 0.6, 1000000),
+    ('#e93a27', 0.7, 0.8, 2000000),
+)
+
+
+def iter_airports(file_name):
+    """
+    :param str file_name: JSON file of airport metrics and passenger statistics
+    :returns: airport metrics and passenger statistics, one airport at a time
+    :rtype: generator
+    """
+    with codecs.open(file_name, 'r+b', 'utf8') as airports_file:
+        for line in airports_file:
+            if line.strip():
+                yield json.loads(line)
 
 
 def load_airports(file_name):
@@ -33,145 +85,775 @@ def load_airports(file_name):
     :returns: airport metrics and passenger statistics
     :rtype: list
     """
-    with codecs.open(file_name, 'r+b', 'utf8') as airports_file:
-        airports = [json.loads(line)
-                    for line in airports_file.read().strip().split('\n')]
+    return list(iter_airports(file_name))
+
+
+def is_iata(iata):
+    return bool(iata) and len(iata) == 3
 
-    return airports
 
+def normalize_wiki_url(url):
+    """
+    Reduce a /wiki/ URL or page title to a form its other spellings share:
+    percent-encoding decoded, transliterated to ASCII, underscores as spaces
+    and in lower case.
+
+    >>> normalize_wiki_url(u'/wiki/Z%C3%BCrich_Airport#Terminals')
+    u'zurich airport'
+    >>> normalize_wiki_url(u'Z\\xfcrich  airport')
+    u'zurich airport'
+    """
+    if url.startswith('/wiki/'):
+        url = url[len('/wiki/'):]
 
-def get_pairs_and_volumes(airports):
+    title = unquote(url.split('#', 1)[0].encode('utf8')).decode('utf8',
+                                                               'replace')
+
+    return u' '.join(unidecode(title).replace('_', ' ').split()).lower()
+
+
+def load_redirects(file_name):
+    """
+    :param str file_name: JSON lines of redirect titles and their targets
+                          written by app.py get_wikipedia_content
+    :returns: normalized targets keyed by normalized redirect title
+    :rtype: dict
     """
-    :param dict airports: airport metrics and passenger statistics
+    redirects = {}
+
+    with codecs.open(file_name, 'r+b', 'utf8') as redirects_file:
+        for line in redirects_file:
+            if line.strip():
+                redirect = json.loads(line)
+                redirects[normalize_wiki_url(redirect['title'])] = \
+                    normalize_wiki_url(redirect['target'])
+
+    return redirects
+
+
+def get_pairs_and_volumes(airports, redirects=None):
+    """
+    :param airports: airport metrics and passenger statistics, any iterable
+                     so they can be streamed from iter_airports
+    :param dict redirects: redirect index from load_redirects
     :returns: IATA pairs lists with passenger counts and IATA lookup list
     :rtype: tuple
 
     A pair is two airports and the volume is the number of passengers travelling
     between these two airports over the course of the latest year reported.
+
+    The airports are read in a single pass. Only the IATA code, URL and
+    passenger count of each route are kept from their passenger maps, the
+    routes' URLs are resolved once every airport has been seen. URLs are
+    normalized, so spellings differing in case, underscores, percent-encoding
+    or accents match. They match an airport's URL or article title, or
+    a redirect to its article.
+
+    >>> pairs, iatas = get_pairs_and_volumes(iter([
+    ...     {'iata': 'LHR', 'url': '/wiki/LHR', 'latitude': 51.5,
+    ...      'longitude': -0.5, 'passengers': {'/wiki/JFK': 3000,
+    ...                                        '/wiki/XYZ': 10}},
+    ...     {'iata': 'JFK', 'url': '/wiki/JFK', 'latitude': 40.6,
+    ...      'longitude': -73.8, 'passengers': {'/wiki/LHR': 2500}},
+    ...     {'iata': None, 'url': '/wiki/Nowhere', 'latitude': 0,
+    ...      'longitude': 0},
+    ... ]))
+    >>> pairs
+    {'JFK-LHR': 2500}
+    >>> sorted(iatas)
+    ['JFK', 'LHR']
+    >>> get_pairs_and_volumes(iter([
+    ...     {'iata': 'LHR', 'url': '/wiki/LHR', 'latitude': 51.5,
+    ...      'longitude': -0.5, 'passengers': {'/wiki/New_York_JFK': 3000}},
+    ...     {'iata': 'JFK', 'url': '/wiki/JFK', 'latitude': 40.6,
+    ...      'longitude': -73.8, 'title': u'John F. Kennedy Airport',
+    ...      'passengers': {'/wiki/heathrow': 2500}},
+    ... ]), {u'new york jfk': u'john f. kennedy airport',
+    ...      u'heathrow': u'lhr'})[0]
+    {'JFK-LHR': 2500}
     """
-    wikiurls = {airport['url']: (airport['iata'],
-                                 airport['latitude'],
-                                 airport['longitude'])
-                for airport in airports
-                if airport['iata'] and len(airport['iata']) == 3}
+    redirects = redirects or {}
+    wikiurls, iatas, routes = {}, {}, []
+
+    for airport in airports:
+        if not is_iata(airport['iata']):
+            continue
 
-    iatas = {airport['iata']: (airport['latitude'],
-                               airport['longitude'])
-             for airport in airports
-             if airport['iata'] and len(airport['iata']) == 3}
+        wikiurls[normalize_wiki_url(airport['url'])] = airport['iata']
+        iatas[airport['iata']] = (airport['latitude'], airport['longitude'])
+
+        if airport.get('title'):
+            wikiurls[normalize_wiki_url(airport['title'])] = airport['iata']
+
+        for url, passenger_count in airport.get('passengers', {}).iteritems():
+            routes.append((airport['iata'], url, passenger_count))
 
     pairs = {}
 
-    for airport in airports:
-        if 'passengers' not in airport:
+    for iata, url, passenger_count in routes:
+        url = normalize_wiki_url(url)
+
+        if url not in wikiurls:
+            url = redirects.get(url)
+
+        if url not in wikiurls:
             continue
 
-        for url, passenger_count in airport['passengers'].iteritems():
-            if url not in wikiurls:
-                continue
+        pair = sorted([iata, wikiurls[url]])
+        pairs['%s-%s' % (pair[0], pair[1])] = passenger_count
 
-            pair = sorted([airport['iata'], wikiurls[url][0]])
+    return pairs, iatas
 
-            if not pair[0] or \
-               not pair[1] or \
-               len(pair[0]) != 3 or \
-               len(pair[1]) != 3:
-                continue
 
-            pairs['%s-%s' % (pair[0], pair[1])] = passenger_count
+"""
+Route store
+"""
+# Columns of a route store, each saved to its own .npy file
+ROUTE_STORE_COLUMNS = ('iatas',
+                       'latitudes',
+                       'longitudes',
+                       'origins',
+                       'destinations',
+                       'passengers')
 
-    return pairs, iatas
 
+def make_route_store(pairs, iatas):
+    """
+    Store the routes column by column. Airports are numbered by their place
+    in the sorted IATA table, each route refers to its two airports by
+    these numbers.
+
+    :param dict pairs: passenger counts keyed by IATA pair
+    :param dict iatas: latitude and longitude keyed by IATA code
+    :returns: NumPy arrays keyed by ROUTE_STORE_COLUMNS
+    :rtype: dict
+
+    >>> store = make_route_store({'JFK-LHR': 2500},
+    ...                          {'LHR': (51.5, -0.5), 'JFK': (40.6, -73.8)})
+    >>> [str(iata) for iata in store['iatas']], store['latitudes'].tolist()
+    (['JFK', 'LHR'], [40.6, 51.5])
+    >>> store['origins'].tolist(), store['destinations'].tolist()
+    ([0], [1])
+    """
+    codes = sorted(iatas)
+    numbers = {iata: number for number, iata in enumerate(codes)}
+    ends = [pair.split('-') for pair in sorted(pairs)]
+
+    return {
+        'iatas': np.array(codes, dtype='U3'),
+        'latitudes': np.array([iatas[iata][0] for iata in codes], float),
+        'longitudes': np.array([iatas[iata][1] for iata in codes], float),
+        'origins': np.array([numbers[iata1] for iata1, _ in ends], np.int32),
+        'destinations': np.array([numbers[iata2] for _, iata2 in ends],
+                                 np.int32),
+        'passengers': np.array([pairs[pair] for pair in sorted(pairs)],
+                               np.int64),
+    }
+
+
+def save_route_store(store, directory):
+    """
+    :param dict store: route store from make_route_store
+    :param str directory: where to save the store's .npy files
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    for column in ROUTE_STORE_COLUMNS:
+        np.save(os.path.join(directory, '%s.npy' % column), store[column])
 
-def prepare_graphing_data(pairs, iatas):
+
+def load_route_store(directory):
+    """
+    :param str directory: directory written by save_route_store
+    :returns: memory-mapped arrays keyed by ROUTE_STORE_COLUMNS
+    :rtype: dict
     """
-    Build a list of flight path lines with a line width and colour 
-    representative of the number of passengers travelling on that route in the
-    latest year reported on.
+    return {column: np.load(os.path.join(directory, '%s.npy' % column),
+                            mmap_mode='r')
+            for column in ROUTE_STORE_COLUMNS}
 
-    :param list pairs: passenger counts for various flight routes.
-    :param list iatas: IATA lookup list
 
-    :returns: list of flight path lines
+def get_tiers(passenger_counts):
+    """
+    :param numpy.ndarray passenger_counts: passengers on each route
+    :returns: index into DISPLAY_PARAMS of the highest threshold each route
+              reaches, the first for counts below every threshold
+    :rtype: numpy.ndarray
+
+    >>> get_tiers(np.array([-5, 0, 249999, 250000, 3000000])).tolist()
+    [0, 0, 0, 1, 4]
+    """
+    thresholds = [threshold for _, _, _, threshold in DISPLAY_PARAMS]
+
+    return np.maximum(np.searchsorted(thresholds,
+                                      passenger_counts,
+                                      side='right') - 1, 0)
+
+
+def get_route_tiers(store, threshold=0):
+    """
+    Build the flight path lines of every route with at least threshold
+    passengers, grouped by the display tier for their number of passengers.
+
+    :param dict store: route store
+    :param int threshold: fewest passengers on a route drawn
+    :returns: colour, alpha, line width and the latitudes and longitudes of
+              both ends of every route, shaped (routes, 4), of each tier in
+              the order they're drawn
     :rtype: list
+
+    >>> store = make_route_store({'JFK-LHR': 2500000, 'CDG-LHR': 100},
+    ...                          {'LHR': (51.5, -0.5), 'JFK': (40.6, -73.8),
+    ...                           'CDG': (49.0, 2.5)})
+    >>> [(colour, coordinates.tolist())
+    ...  for colour, _, _, coordinates in get_route_tiers(store, 1000)]
+    [('#e93a27', [[40.6, -73.8, 51.5, -0.5]])]
     """
-    routes = []
+    passengers = store['passengers']
+    selected = np.flatnonzero(passengers >= threshold)
+    tiers = get_tiers(passengers[selected])
+    origins = store['origins'][selected]
+    destinations = store['destinations'][selected]
+    coordinates = np.column_stack([store['latitudes'][origins],
+                                   store['longitudes'][origins],
+                                   store['latitudes'][destinations],
+                                   store['longitudes'][destinations]])
+
+    # Tiers are drawn in the order of their colour, alpha and line width
+    return sorted([DISPLAY_PARAMS[tier][:3] + (coordinates[tiers == tier],)
+                   for tier in np.unique(tiers)],
+                  key=lambda tier: tier[:3])
+
+
+def get_great_circles(coordinates, spacing=100.0):
+    """
+    Compute the great circle arcs of every route at once. The arcs all have
+    the same number of points, enough for the longest to have one roughly
+    every spacing kilometres like Basemap.drawgreatcircle.
+
+    :param numpy.ndarray coordinates: latitudes and longitudes of both ends
+                                      of every route, shaped (routes, 4)
+    :param float spacing: kilometres between the points of the longest arc
+    :returns: the longitude and latitude of each arc's points, shaped
+              (routes, points, 2)
+    :rtype: numpy.ndarray
+
+    >>> arcs = get_great_circles(np.array([[0, 0, 0, 90], [0, 170, 0, -170]]))
+    >>> np.allclose(arcs[:, [0, -1]], [[[0, 0], [90, 0]],
+    ...                                [[170, 0], [-170, 0]]])
+    True
+    >>> np.allclose(arcs[0, :, 1], 0), bool(arcs[1, :, 0].max() > 179)
+    (True, True)
+    """
+    if not len(coordinates):
+        return np.zeros((0, 2, 2))
+
+    lat1, long1, lat2, long2 = np.radians(np.asarray(coordinates, float)).T
+    start = np.column_stack([np.cos(lat1) * np.cos(long1),
+                             np.cos(lat1) * np.sin(long1),
+                             np.sin(lat1)])
+    end = np.column_stack([np.cos(lat2) * np.cos(long2),
+                           np.cos(lat2) * np.sin(long2),
+                           np.sin(lat2)])
+    omega = np.arccos(np.clip((start * end).sum(axis=1), -1, 1))[:, None]
+
+    points = int(np.clip(omega.max() * EARTH_RADIUS / spacing, 2, 500))
+    steps = np.linspace(0, 1, points)
+
+    # Spherical linear interpolation, routes between the same or opposite
+    # points are interpolated linearly instead.
+    sin_omega = np.sin(omega)
+    flat = sin_omega < 1e-9
+    sin_omega[flat] = 1
+    weight1 = np.where(flat,
+                       1 - steps,
+                       np.sin((1 - steps) * omega) / sin_omega)
+    weight2 = np.where(flat, steps, np.sin(steps * omega) / sin_omega)
+    xyz = weight1[:, :, None] * start[:, None, :] + \
+          weight2[:, :, None] * end[:, None, :]
+
+    return np.dstack([
+        np.degrees(np.arctan2(xyz[:, :, 1], xyz[:, :, 0])),
+        np.degrees(np.arctan2(xyz[:, :, 2], np.hypot(xyz[:, :, 0],
+                                                     xyz[:, :, 1]))),
+    ])
+
+
+def split_at_antimeridian(arcs):
+    """
+    Split arcs into line segments wherever they cross the antimeridian. The
+    segments on either side of each crossing end on the edge of the map so
+    the line doesn't have a gap.
 
-    display_params = (
-        # color   alpha  width threshold
-        ('#e5cccf', 0.3, 0.2, 0),
-        ('#f7c4b1', 0.4, 0.3, 250000),
-        ('#ed8d75', 0.5, 0.4, 500000),
-        ('#ef684b', 0.6, 0.6, 1000000),
-        ('#e93a27', 0.7, 0.8, 2000000),
-    )
+    :param numpy.ndarray arcs: arcs from get_great_circles
+    :returns: line segments, arrays of longitudes and latitudes
+    :rtype: list
 
-    for iata_pair, passenger_count in pairs.iteritems():
-        colour, alpha, linewidth, _ = display_params[0]
+    >>> segments = split_at_antimeridian(np.array([[[170., 0.], [-170., 10.]],
+    ...                                            [[10., 0.], [20., 0.]]]))
+    >>> [segment.tolist() for segment in segments]
+    [[[10.0, 0.0], [20.0, 0.0]], [[170.0, 0.0], [180.0, 5.0]], \
+[[-180.0, 5.0], [-170.0, 10.0]]]
+    """
+    jumps = np.abs(np.diff(arcs[:, :, 0], axis=1)) > 180
+    crossing = jumps.any(axis=1)
+    segments = list(arcs[~crossing])
+
+    for arc, arc_jumps in zip(arcs[crossing], jumps[crossing]):
+        start, head = 0, arc[:0]
+
+        for index in np.flatnonzero(arc_jumps):
+            (long1, lat1), (long2, lat2) = arc[index], arc[index + 1]
+            edge = 180.0 if long1 > 0 else -180.0
+            lat = lat1 + (lat2 - lat1) * (edge - long1) / \
+                         (long2 + 2 * edge - long1)
+            segments.append(np.vstack([head,
+                                       arc[start:index + 1],
+                                       [[edge, lat]]]))
+            start, head = index + 1, np.array([[-edge, lat]])
 
-        for _colour, _alpha, _linewidth, _threshold in display_params:
-            if _threshold > passenger_count:
-                break
+        segments.append(np.vstack([head, arc[start:]]))
 
-            colour, alpha, linewidth = _colour, _alpha, _linewidth
+    return segments
 
-        iata1, iata2 = iata_pair.split('-')
 
-        routes.append((colour, 
-                       alpha,
-                       linewidth,
-                       iatas[iata1][0],
-                       iatas[iata1][1],
-                       iatas[iata2][0],
-                       iatas[iata2][1]))
+def project_segments(m, segments):
+    """
+    Project every line segment's points with a single call to the map.
+    """
+    if not segments:
+        return []
 
-    return routes
+    points = np.concatenate(segments)
+    x, y = m(points[:, 0], points[:, 1])
 
+    return np.split(np.column_stack([x, y]),
+                    np.cumsum([len(segment) for segment in segments])[:-1])
 
-def save_map(routes, file_name):
+
+def get_map(bbox=None):
+    """
+    :param list bbox: west, south, east and north edges of the map in
+                      degrees, the whole world when None
+    :rtype: Basemap
     """
-    Render flight routes to an image file.
+    if bbox is None:
+        return Basemap(projection='cyl', lon_0=0, resolution='c')
 
-    :param list routes: flight path lines
-    :param str file_name: image output file name
+    west, south, east, north = bbox
+
+    return Basemap(projection='cyl',
+                   llcrnrlon=west,
+                   llcrnrlat=south,
+                   urcrnrlon=east,
+                   urcrnrlat=north,
+                   resolution='c')
+
+
+def get_figure_size(bbox=None):
+    """
+    Regional maps are as wide as the world map and as high as their aspect
+    ratio needs.
+
+    >>> get_figure_size([-40, 30, 40, 70])
+    (7.195, 3.5975)
+    """
+    if bbox is None:
+        return FIGURE_SIZE
+
+    west, south, east, north = bbox
+
+    return (FIGURE_SIZE[0],
+            FIGURE_SIZE[0] * (north - south) / float(east - west))
+
+
+def get_pixel_size(figsize, dpi):
     """
-    fig = plt.figure(figsize=(7.195, 3.841), dpi=100)
-    m = Basemap(projection='cyl', lon_0=0, resolution='c')
-    ax = plt.Axes(fig, [0., 0., 1., 1.])
+    :returns: width and height in pixels of a figure drawn at dpi, rounded
+              down like the Agg renderer does
+    :rtype: tuple
+    """
+    return int(figsize[0] * dpi), int(figsize[1] * dpi)
+
+
+def iter_strips(height, tile_size=None):
+    """
+    :param int height: image height in pixels
+    :param int tile_size: most rows in a strip, all of them when None
+    :returns: first and last (exclusive) rows of each strip
+    :rtype: generator
+
+    >>> list(iter_strips(5, 2))
+    [(0, 2), (2, 4), (4, 5)]
+    """
+    tile_size = tile_size or height
+
+    for top in xrange(0, height, tile_size):
+        yield top, min(top + tile_size, height)
+
+
+def make_figure(figsize=FIGURE_SIZE, dpi=100, rows=None):
+    """
+    :param tuple figsize: figure width and height in inches
+    :param int dpi: dots per inch of the figure
+    :param tuple rows: first and last (exclusive) pixel rows, counted from
+                       the top, of the figure to draw. The figure is cut
+                       down to these rows and its axes kept in place so the
+                       strip matches the same rows of the whole figure.
+    :returns: figure and its axes covering all of it
+    :rtype: tuple
+    """
+    if rows is None:
+        fig = plt.figure(figsize=figsize, dpi=dpi)
+        position = [0., 0., 1., 1.]
+    else:
+        top, bottom = rows
+        height = figsize[1] * dpi
+        # Slightly over the strip's height so it isn't rounded down a row
+        strip = bottom - top + 0.001
+        fig = plt.figure(figsize=(figsize[0], strip / dpi), dpi=dpi)
+        position = [0., (strip + top - height) / strip, 1., height / strip]
+
+    ax = plt.Axes(fig, position)
     ax.set_axis_off()
+    ax.patch.set_visible(False)
     fig.add_axes(ax)
 
-    for (colour, alpha, linewidth, lat1, long1, lat2, long2) in sorted(routes):
-        """
-        Cannot handle situations in which the great circle intersects the 
-        edge of the map projection domain, and then re-enters the domain.
+    return fig, ax
 
-        Fix from: http://stackoverflow.com/questions/13888566/
-        """
-        line, = m.drawgreatcircle(long1, lat1, long2, lat2,
-                                  linewidth=linewidth,
-                                  color=colour,
-                                  alpha=alpha,
-                                  solid_capstyle='round')
 
-        p = line.get_path()
+def get_canvas(fig):
+    """
+    :returns: the figure drawn at its dpi, shaped (height, width, 4)
+    :rtype: numpy.ndarray
+    """
+    fig.canvas.draw()
+    width, height = fig.canvas.get_width_height()
 
-        # Find the index which crosses the dateline (the delta is large)
-        cut_point = np.where(np.abs(np.diff(p.vertices[:, 0])) > 200)[0]
+    return np.frombuffer(fig.canvas.buffer_rgba(), np.uint8) \
+             .reshape(height, width, 4)
 
-        if cut_point:
-            cut_point = cut_point[0]
 
-            # Create new vertices with a nan in between and set 
-            # those as the path's vertices
-            new_verts = np.concatenate([p.vertices[:cut_point, :], 
-                                        [[np.nan, np.nan]], 
-                                        p.vertices[cut_point+1:, :]])
-            p.codes = None
-            p.vertices = new_verts
+def get_background(m, dpi, figsize=FIGURE_SIZE, image=BACKGROUND_IMAGE,
+                   cache_dir=None, tile_size=None):
+    """
+    Warp the background image onto the map and rasterise the whole figure at
+    the output image's size, tile_size rows at a time. Rasters are cached in
+    cache_dir keyed by the map's projection and extent, the size and the
+    background image so later renders skip the warp.
 
-    m.warpimage(image="earth_lights_lrg.jpg")
-    plt.savefig(file_name, dpi=1000)
+    :returns: the figure's background, shaped (height, width, 3)
+    :rtype: numpy.ndarray
+    """
+    extent = [m.llcrnrlon, m.llcrnrlat, m.urcrnrlon, m.urcrnrlat]
+    key = sha1(json.dumps([m.projparams,
+                           extent,
+                           figsize,
+                           dpi,
+                           os.path.abspath(image),
+                           os.path.getmtime(image)],
+                          sort_keys=True,
+                          default=str)).hexdigest()
+    cache_file = os.path.join(cache_dir or '', '%s.npy' % key)
+
+    if cache_dir is not None and os.path.exists(cache_file):
+        return np.load(cache_file, mmap_mode='r')
+
+    width, height = get_pixel_size(figsize, dpi)
+
+    if cache_dir is None:
+        background = np.empty((height, width, 3), np.uint8)
+    else:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # Renders running in parallel may miss the cache at the same time
+        temp_file = os.path.join(cache_dir,
+                                 '%s.%d.tmp.npy' % (key, os.getpid()))
+        background = np.lib.format.open_memmap(temp_file,
+                                               mode='w+',
+                                               dtype=np.uint8,
+                                               shape=(height, width, 3))
+
+    for top, bottom in iter_strips(height, tile_size):
+        fig, ax = make_figure(figsize, dpi, (top, bottom))
+        m.set_axes_limits(ax=ax)
+        m.warpimage(image=image, ax=ax)
+        background[top:bottom] = get_canvas(fig)[:, :, :3]
+        plt.close(fig)
+
+    if cache_dir is not None:
+        background.flush()
+        del background
+        os.rename(temp_file, cache_file)
+
+        return np.load(cache_file, mmap_mode='r')
+
+    return background
+
+
+def get_route_lines(m, tiers):
+    """
+    Project the great circles of every display tier's routes.
+
+    :param list tiers: display tiers from get_route_tiers
+    :returns: colour, alpha, line width and projected line segments of each
+              tier, in the order they're drawn
+    :rtype: list
+    """
+    return [(colour,
+             alpha,
+             linewidth,
+             project_segments(m, split_at_antimeridian(
+                 get_great_circles(coordinates))))
+            for colour, alpha, linewidth, coordinates in tiers]
+
+
+def draw_route_lines(m, ax, lines):
+    """
+    Draw the routes of each display tier as a single LineCollection.
+    """
+    for colour, alpha, linewidth, segments in lines:
+        ax.add_collection(LineCollection(segments,
+                                         colors=colour,
+                                         alpha=alpha,
+                                         linewidths=linewidth,
+                                         capstyle='round'))
+
+    m.set_axes_limits(ax=ax)
+
+
+def iter_map_strips(m, lines, figsize, dpi, background, tile_size=None):
+    """
+    Draw the routes over the background tile_size rows at a time. Each
+    strip's routes are drawn on a transparent figure and blended onto the
+    background's rows.
+
+    :returns: RGB rows of each strip, shaped (rows, width, 3)
+    :rtype: generator
+    """
+    for top, bottom in iter_strips(len(background), tile_size):
+        fig, ax = make_figure(figsize, dpi, (top, bottom))
+        fig.patch.set_alpha(0)
+        draw_route_lines(m, ax, lines)
+        canvas = get_canvas(fig)
+        alpha = canvas[:, :, 3:] / 255.
+        yield (canvas[:, :, :3] * alpha +
+               background[top:bottom] * (1 - alpha)).round().astype(np.uint8)
+        plt.close(fig)
+
+
+def write_png(file_name, strips, width, height, dpi):
+    """
+    Write an RGB PNG one strip of rows at a time so the whole image is never
+    held in memory.
+
+    :param str file_name: image output file name
+    :param strips: RGB rows, top to bottom, shaped (rows, width, 3)
+    :param int width: image width in pixels
+    :param int height: image height in pixels
+    :param int dpi: dots per inch of the image
+    """
+    def write_chunk(f, kind, data):
+        f.write(struct.pack('>I', len(data)))
+        f.write(kind + data)
+        f.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    compressor = zlib.compressobj(6)
+    pixels_per_metre = int(round(dpi / 0.0254))
+
+    with open(file_name, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        write_chunk(f, b'IHDR', struct.pack('>IIBBBBB',
+                                            width, height, 8, 2, 0, 0, 0))
+        write_chunk(f, b'pHYs', struct.pack('>IIB',
+                                            pixels_per_metre,
+                                            pixels_per_metre,
+                                            1))
+
+        for strip in strips:
+            # Every row is stored with the Sub filter, the difference from
+            # the pixel to its left
+            pixels = strip.reshape(len(strip), width * 3)
+            rows = np.empty((len(strip), width * 3 + 1), np.uint8)
+            rows[:, 0] = 1
+            rows[:, 1:4] = pixels[:, :3]
+            np.subtract(pixels[:, 3:], pixels[:, :-3], out=rows[:, 4:])
+            data = compressor.compress(rows.tobytes())
+
+            if data:
+                write_chunk(f, b'IDAT', data)
+
+        write_chunk(f, b'IDAT', compressor.flush())
+        write_chunk(f, b'IEND', b'')
+
+
+def save_map(tiers, file_names, dpi=1000, background_cache=None,
+             bbox=None, tile_size=None):
+    """
+    Render flight routes to image files. The background is rendered
+    separately so it can be cached and shared by every file. PNGs are drawn
+    and written tile_size rows at a time, other formats are drawn in one go
+    by matplotlib.
+
+    :param list tiers: display tiers of the routes from get_route_tiers
+    :param list file_names: image output file names
+    :param int dpi: dots per inch of the images
+    :param str background_cache: directory to cache backgrounds in
+    :param list bbox: west, south, east and north edges of the map, the
+                      whole world when None
+    :param int tile_size: most pixel rows of a PNG drawn at a time
+    """
+    m = get_map(bbox)
+    figsize = get_figure_size(bbox)
+    background = get_background(m,
+                                dpi,
+                                figsize,
+                                cache_dir=background_cache,
+                                tile_size=tile_size)
+    lines = get_route_lines(m, tiers)
+
+    for file_name in file_names:
+        if file_name.lower().endswith('.png'):
+            height, width = background.shape[:2]
+            write_png(file_name,
+                      iter_map_strips(m,
+                                      lines,
+                                      figsize,
+                                      dpi,
+                                      background,
+                                      tile_size),
+                      width,
+                      height,
+                      dpi)
+            continue
+
+        fig = plt.figure(figsize=figsize, dpi=100)
+        background_ax = fig.add_axes([0., 0., 1., 1.], zorder=0)
+        background_ax.set_axis_off()
+        background_ax.imshow(background,
+                             aspect='auto',
+                             interpolation='nearest')
+
+        ax = plt.Axes(fig, [0., 0., 1., 1.], zorder=1)
+        ax.set_axis_off()
+        ax.patch.set_visible(False)
+        fig.add_axes(ax)
+        draw_route_lines(m, ax, lines)
+
+        plt.savefig(file_name, dpi=dpi)
+        plt.close(fig)
+
+
+"""
+Map variants
+"""
+def load_variants(file_name=None):
+    """
+    Variants are read from a JSON list of objects, each with an optional
+    name, bbox (west, south, east and north edges in degrees), threshold
+    (fewest passengers on a route drawn) and dpi.
+
+    :param str file_name: JSON variants file, a single default variant when
+                          None
+    :returns: variants with every setting filled in, None for defaults
+    :rtype: list
+
+    >>> sorted(load_variants()[0].items())
+    [('bbox', None), ('dpi', None), ('name', None), ('threshold', 0)]
+    """
+    variants = [{}]
+
+    if file_name is not None:
+        with codecs.open(file_name, 'r', 'utf8') as variants_file:
+            variants = json.load(variants_file)
+
+    for variant in variants:
+        unknown = set(variant) - set(['name', 'bbox', 'threshold', 'dpi'])
+
+        if unknown:
+            raise ValueError('Unknown variant settings: %s' %
+                             ', '.join(sorted(unknown)))
+
+        variant.setdefault('name', None)
+        variant.setdefault('bbox', None)
+        variant.setdefault('threshold', 0)
+        variant.setdefault('dpi', None)
+
+        if variant['bbox'] is not None:
+            west, south, east, north = variant['bbox']
+
+            if west >= east or south >= north:
+                raise ValueError('bbox must be west, south, east, north: %r' %
+                                 variant['bbox'])
+
+    return variants
+
+
+def get_variant_file_name(file_name, name=None):
+    """
+    >>> get_variant_file_name('out.png', 'europe')
+    'out-europe.png'
+    >>> get_variant_file_name('out.svg')
+    'out.svg'
+    """
+    if name is None:
+        return file_name
+
+    base, extension = os.path.splitext(file_name)
+
+    return '%s-%s%s' % (base, name, extension)
+
+
+def render_maps(stats_file, file_names, variants, dpi=1000, workers=1,
+                background_cache=None, tile_size=None, redirects=None):
+    """
+    Render every variant of the map to each of the image files. The
+    passenger statistics are read once, the variants are then rendered in
+    parallel by a pool of worker processes.
+
+    :param str stats_file: JSON file of airport metrics and passenger
+                           statistics, or a route store compiled from one
+    :param list file_names: image output file names
+    :param list variants: variants from load_variants
+    :param int dpi: dots per inch of variants without their own
+    :param int workers: number of processes to render variants with
+    :param str background_cache: directory to cache backgrounds in
+    :param int tile_size: most pixel rows of a PNG drawn at a time
+    :param dict redirects: redirect index from load_redirects, route stores
+                           are resolved with theirs when compiled
+    """
+    if os.path.isdir(stats_file):
+        store = load_route_store(stats_file)
+    else:
+        store = make_route_store(
+            *get_pairs_and_volumes(iter_airports(stats_file), redirects))
+
+    jobs = []
+
+    for variant in variants:
+        jobs.append((get_route_tiers(store, variant['threshold']),
+                     [get_variant_file_name(file_name, variant['name'])
+                      for file_name in file_names],
+                     variant['dpi'] or dpi,
+                     background_cache,
+                     variant['bbox'],
+                     tile_size))
+
+    if workers < 2 or len(jobs) < 2:
+        for job in jobs:
+            save_map(*job)
+        return
+
+    pool = Pool(processes=min(workers, len(jobs)))
+
+    try:
+        for result in [pool.apply_async(save_map, job) for job in jobs]:
+            result.get()
+    finally:
+        pool.close()
+        pool.join()
 
 
 """
@@ -183,11 +865,37 @@ def main(argv):
     """
     opt = docopt(__doc__, argv)
 
+    if opt['test']:
+        import doctest
+        doctest.testmod()
+        return
+
+    redirects = None
+
+    if opt['--redirects']:
+        redirects = load_redirects(opt['--redirects'])
+
+    if opt['compile']:
+        pairs, iatas = get_pairs_and_volumes(
+            iter_airports(opt['<stats_file>']), redirects)
+        save_route_store(make_route_store(pairs, iatas), opt['<store_dir>'])
+        return
+
     if opt['render']:
-        airports = load_airports(opt['<stats_file>'])
-        pairs, iatas = get_pairs_and_volumes(airports)
-        routes = prepare_graphing_data(pairs, iatas)
-        save_map(routes, opt['<image_file>'])
+        try:
+            variants = load_variants(opt['--variants'])
+        except ValueError as exc:
+            print >> sys.stderr, exc
+            return
+
+        render_maps(opt['<stats_file>'],
+                    opt['<image_file>'],
+                    variants,
+                    dpi=int(opt['--dpi']),
+                    workers=int(opt['--workers']),
+                    background_cache=opt['--background-cache'],
+                    tile_size=int(opt['--tile-size']),
+                    redirects=redirects)
 
 
 if __name__ == "__main__":